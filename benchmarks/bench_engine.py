@@ -0,0 +1,147 @@
+"""テンプレートエンジンのベンチマーク (合成タグライブラリを使用)
+
+    python benchmarks/bench_engine.py --files 20 --depth 3 --width 6 --leaves 12 --templates 8 --range 1-3
+
+読み込み時間、組み合わせ数の計算時間、ランダム・ラウンドロビン展開のスループットと、各段階のピークメモリを出力する。
+--json を付けると結果を JSON で出力する (リグレッションの比較用)。
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from lib_easy_prompt_selector.engine import (
+    combination_at,
+    count_combinations,
+    generate_combinations,
+    replace_template_random_batch,
+    resolve_templates,
+    template_combinations_count,
+)
+from lib_easy_prompt_selector.tags import TagLoader
+from lib_easy_prompt_selector.templates import compile_prompt
+from synthetic import synthetic_prompt, write_tag_library
+
+
+def timed(fn, repeat):
+    """(最良の実行時間, 結果)"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def clear_caches(library):
+    library.derived.clear()
+    compile_prompt.cache_clear()
+    template_combinations_count.cache_clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--width', type=int, default=6)
+    parser.add_argument('--leaves', type=int, default=12)
+    parser.add_argument('--templates', type=int, default=8)
+    parser.add_argument('--range', default='1-3', help="n-m for every template (n$$ when n == m)")
+    parser.add_argument('--images', type=int, default=10000, help="prompts expanded per throughput stage")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    min_count, _, max_count = args.range.partition('-')
+    min_count = int(min_count)
+    max_count = int(max_count or min_count)
+
+    results = {'parameters': vars(args)}
+    with tempfile.TemporaryDirectory() as tags_dir:
+        names = write_tag_library(tags_dir, args.files, args.depth, args.width, args.leaves, args.seed)
+        prompt = synthetic_prompt(names, args.depth, args.width, args.templates, min_count, max_count, args.seed)
+
+        load_time, library = timed(lambda: TagLoader(Path(tags_dir)).load(), args.repeat)
+        results['load'] = {
+            'seconds': load_time,
+            'peak_bytes': peak_memory(lambda: TagLoader(Path(tags_dir)).load()),
+            'files': len(library),
+        }
+
+    def count_cold():
+        clear_caches(library)
+        return count_combinations(library, prompt)
+
+    cold_time, count = timed(count_cold, args.repeat)
+    warm_time, _ = timed(lambda: count_combinations(library, prompt), args.repeat)
+    results['count'] = {
+        'cold_seconds': cold_time,
+        'warm_seconds': warm_time,
+        'total_bits': count.total.bit_length(),
+        'error': count.error,
+    }
+
+    seeds = list(range(args.images))
+    prompts = [prompt] * args.images
+    random_time, _ = timed(lambda: replace_template_random_batch(library, prompts, seeds, 'Input Prompt'), args.repeat)
+    results['random'] = {
+        'prompts_per_second': args.images / random_time,
+        'peak_bytes': peak_memory(lambda: replace_template_random_batch(library, prompts, seeds, 'Input Prompt')),
+    }
+
+    compiled = compile_prompt(prompt)
+    resolved = resolve_templates(library, compiled.templates)
+    if not isinstance(resolved, str):
+        def round_robin():
+            for index in range(args.images):
+                compiled.substitute(combination_at(resolved, index))
+
+        round_robin_time, _ = timed(round_robin, args.repeat)
+        jump_time, _ = timed(lambda: compiled.substitute(combination_at(resolved, count.total - 1)), args.repeat)
+        first_time, _ = timed(lambda: next(generate_combinations(library, compiled.templates)), args.repeat)
+        results['round_robin'] = {
+            'prompts_per_second': args.images / round_robin_time,
+            'jump_to_last_seconds': jump_time,
+            'first_combination_seconds': first_time,
+            'peak_bytes': peak_memory(round_robin),
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    print(f"prompt: {prompt}")
+    print(f"load             {results['load']['seconds'] * 1000:10.2f} ms   peak {results['load']['peak_bytes'] / 2**20:8.2f} MiB")
+    print(f"count (cold)     {cold_time * 1e6:10.1f} us   combinations ~2^{results['count']['total_bits']}")
+    print(f"count (cached)   {warm_time * 1e6:10.1f} us")
+    print(f"random           {results['random']['prompts_per_second']:10.0f} prompts/s   peak {results['random']['peak_bytes'] / 2**20:8.2f} MiB")
+    if 'round_robin' in results:
+        rr = results['round_robin']
+        print(f"round robin      {rr['prompts_per_second']:10.0f} prompts/s   peak {rr['peak_bytes'] / 2**20:8.2f} MiB")
+        print(f"  jump to last   {rr['jump_to_last_seconds'] * 1e6:10.1f} us")
+        print(f"  first result   {rr['first_combination_seconds'] * 1e6:10.1f} us")
+    else:
+        print(f"round robin      skipped: {resolved}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""タグ読み込みのコールドスタート / ウォームスタートの計測
+
+    python benchmarks/bench_load_tags.py [tags_dir] [--repeat N] [--top N]
+
+最後に、読み込んだライブラリのファイルごとのメモリ使用量 (大きい順) を出力する。
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import yaml
+
+from lib_easy_prompt_selector.tags import YAML_LOADER, TagLoader
+
+
+def measure(label, make_loader, repeat):
+    timings = []
+    library = None
+    for _ in range(repeat):
+        loader = make_loader()
+        start = time.perf_counter()
+        library = loader.load()
+        timings.append(time.perf_counter() - start)
+    print(f"{label:<40} best {min(timings) * 1000:9.2f} ms   mean {sum(timings) / len(timings) * 1000:9.2f} ms")
+    return library
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tags_dir', nargs='?', default=Path(__file__).resolve().parent.parent / 'tags', type=Path)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help="files listed in the memory report")
+    args = parser.parse_args()
+
+    print(f"tags: {args.tags_dir} ({sum(1 for _ in args.tags_dir.rglob('*.yml'))} files), yaml loader: {YAML_LOADER.__name__}")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_file = Path(cache_dir) / 'tags.pickle'
+
+        def cold():
+            cache_file.unlink(missing_ok=True)
+            return TagLoader(args.tags_dir, cache_file=cache_file)
+
+        reference = measure("cold (safe_load, pure Python)", lambda: TagLoader(args.tags_dir, yaml_loader=yaml.SafeLoader), args.repeat)
+        library = measure(f"cold ({YAML_LOADER.__name__}, writes cache)", cold, args.repeat)
+        cached = measure("warm (disk cache)", lambda: TagLoader(args.tags_dir, cache_file=cache_file), args.repeat)
+
+        loader = TagLoader(args.tags_dir, cache_file=cache_file)
+        loader.load()
+        measure("reload, nothing changed", lambda: loader, args.repeat)
+
+    same = dict(reference) == dict(library) == dict(cached)
+    print(f"identical results: {same}")
+
+    report = sorted(library.memory_report(), key=lambda entry: entry['total_bytes'], reverse=True)
+    print(f"memory: {sum(entry['total_bytes'] for entry in report) / 1024:.1f} KiB in {len(report)} files (largest first)")
+    for entry in report[:args.top]:
+        print(f"  {entry['total_bytes'] / 1024:8.1f} KiB  {entry['options']:6d} options  shared {entry['shared_string_bytes'] / 1024:7.1f} KiB  {entry['file']}")
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
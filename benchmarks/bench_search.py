@@ -0,0 +1,63 @@
+"""タグ検索索引のベンチマーク (合成タグライブラリを使用)
+
+    python benchmarks/bench_search.py --files 50 --depth 3 --width 6 --leaves 12
+
+索引の構築時間、1 ファイルを変更したときの再構築時間と、クエリごとの検索時間 (結果のキャッシュなし) を出力する。
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from lib_easy_prompt_selector.search import SearchIndex
+from lib_easy_prompt_selector.tags import TagLibrary, TagLoader
+from synthetic import write_tag_library
+
+QUERIES = ('s', 'sm', 'smile', 'smlie', 'long hair', 'node3', 'leaf11', 'onsen', 'kimono', 'xyz')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--width', type=int, default=6)
+    parser.add_argument('--leaves', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_tag_library(directory, args.files, args.depth, args.width, args.leaves, args.seed)
+        library = TagLoader(Path(directory)).load()
+
+    start = time.perf_counter()
+    index = SearchIndex(library)
+    build = time.perf_counter() - start
+    entries = sum(len(shard.entries) for shard in index.files.values())
+    print(f"{entries} entries in {len(index.files)} files, build {build * 1000:.1f} ms")
+
+    # 1 ファイルだけ変更されたライブラリ (他のファイルの索引は再利用される)
+    changed = next(iter(library))
+    files = {name: library.file_index(name) for name in library}
+    files[changed] = library[changed]
+    start = time.perf_counter()
+    SearchIndex(TagLibrary(files, library, {changed}), index)
+    print(f"rebuild after changing 1 file {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    for query in QUERIES:
+        timings = []
+        for _ in range(args.repeat):
+            index._results.clear()
+            index._cached_entries = 0
+            start = time.perf_counter()
+            page = index.search(query, limit=50)
+            timings.append(time.perf_counter() - start)
+        print(f"{query!r:<14} best {min(timings) * 1000:7.3f} ms   mean {sum(timings) / len(timings) * 1000:7.3f} ms   {page['total']} hits")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""ベンチマーク用の合成タグライブラリとプロンプト"""
+import random
+from pathlib import Path
+
+import yaml
+
+WORDS = (
+    'standing', 'sitting', 'smile', 'blush', 'long hair', 'short hair', 'school uniform', 'kimono',
+    'outdoors', 'indoors', 'night', 'sunset', 'onsen', 'forest', 'looking at viewer', 'from above',
+)
+
+
+def synthetic_tag_tree(depth, width, leaves, rng):
+    """深さ depth、各階層 width 個のカテゴリ、末端に leaves 個の値を持つ入れ子の辞書"""
+    if depth == 0:
+        return {f"leaf{i}": ', '.join(rng.sample(WORDS, 4)) for i in range(leaves)}
+    return {f"node{i}": synthetic_tag_tree(depth - 1, width, leaves, rng) for i in range(width)}
+
+
+def write_tag_library(directory, files, depth, width, leaves, seed=0):
+    """directory に files 個の YAML を書き、各ファイル名を返す"""
+    rng = random.Random(seed)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    names = []
+    for i in range(files):
+        name = f"synthetic{i:03d}"
+        tree = synthetic_tag_tree(depth, width, leaves, rng)
+        (directory / f"{name}.yml").write_text(yaml.safe_dump(tree, allow_unicode=True), encoding='utf-8')
+        names.append(name)
+    return names
+
+
+def synthetic_prompt(names, depth, width, templates, min_count, max_count, seed=0):
+    """templates 個の @min-max$$ファイル:node..@ を含むプロンプト"""
+    rng = random.Random(seed)
+    parts = ['masterpiece, best quality']
+    for _ in range(templates):
+        ref = [rng.choice(names)] + [f"node{rng.randrange(width)}" for _ in range(rng.randrange(depth + 1))]
+        count = f"{min_count}-{max_count}" if min_count != max_count else f"{min_count}"
+        parts.append(f"@{count}$${':'.join(ref)}@")
+    return ', '.join(parts)
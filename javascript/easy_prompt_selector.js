@@ -1,3 +1,7 @@
+// タグの値の先頭の "3::" はランダム選択の重みなので、ボタンの表示と挿入する文字列からは取り除く
+const EPS_WEIGHT_PREFIX = /^\s*(\d+(\.\d*)?|\.\d+)::/
+const stripWeight = (value) => typeof value === 'string' ? value.replace(EPS_WEIGHT_PREFIX, '') : value
+
 class EPSElementBuilder {
   // Templates
   static baseButton(text, { size = 'sm', color = 'primary' }) {
@@ -126,22 +130,33 @@ class EPSElementBuilder {
 }
 
 class EasyPromptSelector {
-  PATH_FILE = 'tmp/easyPromptSelector.txt'
+  FILES_URL = 'easy-prompt-selector/files'
   AREA_ID = 'easy-prompt-selector'
   SELECT_ID = 'easy-prompt-selector-select'
   CONTENT_ID = 'easy-prompt-selector-content'
   TO_NEGATIVE_PROMPT_ID = 'easy-prompt-selector-to-negative-prompt'
+  // 長いリストは一度にこの数ずつボタンを作る
+  RENDER_CHUNK_SIZE = 200
 
   constructor(yaml, gradioApp) {
     this.yaml = yaml
     this.gradioApp = gradioApp
     this.visible = false
     this.toNegative = false
-    this.tags = undefined
+    this.files = {}       // ファイル名 -> 内容のハッシュ
+    this.tags = {}        // 取得済みのファイルのタグ (ファイル名 -> データ)
+    this.tagDigests = {}  // 取得済みのファイルのハッシュ
   }
 
   async init() {
-    this.tags = await this.parseFiles()
+    this.files = await this.fetchFileIndex()
+    // 内容が変わったファイルや削除されたファイルは、次に開いたときに取得し直す
+    Object.keys(this.tags).forEach((name) => {
+      if (this.files[name] !== this.tagDigests[name]) {
+        delete this.tags[name]
+        delete this.tagDigests[name]
+      }
+    })
 
     const tagArea = gradioApp().querySelector(`#${this.AREA_ID}`)
     if (tagArea != null) {
@@ -155,28 +170,32 @@ class EasyPromptSelector {
       .after(this.render())
   }
 
-  async readFile(filepath) {
-    const response = await fetch(`file=${filepath}?${new Date().getTime()}`);
+  // 最初はファイルの一覧だけを取得し、タグの中身はドロップダウンで選ばれたファイルの分だけ取得する
+  async fetchFileIndex() {
+    const response = await fetch(this.FILES_URL, { cache: 'no-cache' })
+    if (!response.ok) {
+      console.error(`EasyPromptSelector: failed to fetch tag files (${response.status})`)
+      return this.files
+    }
 
-    return await response.text();
+    const index = await response.json()
+    return index.files
   }
 
-  async parseFiles() {
-    const text = await this.readFile(this.PATH_FILE);
-    if (text === '') { return {} }
-
-    const paths = text.split(/\r\n|\n/)
+  // URL に内容のハッシュを付けるので、変更されていないファイルはブラウザのキャッシュから読まれる
+  async fetchFile(name) {
+    const digest = this.files[name]
+    if (this.tags[name] !== undefined && this.tagDigests[name] === digest) { return this.tags[name] }
 
-    const tags = {}
-    for (const path of paths) {
-      const filename = path.split('/').pop().split('.').slice(0, -1).join('.')
-      const data = await this.readFile(path)
-      yaml.loadAll(data, function (doc) {
-        tags[filename] = doc
-      })
+    const response = await fetch(`${this.FILES_URL}/${encodeURIComponent(name)}?v=${encodeURIComponent(digest)}`)
+    if (!response.ok) {
+      console.error(`EasyPromptSelector: failed to fetch tag file ${name} (${response.status})`)
+      return undefined
     }
 
-    return tags
+    this.tags[name] = await response.json()
+    this.tagDigests[name] = digest
+    return this.tags[name]
   }
 
   // Render
@@ -211,52 +230,61 @@ class EasyPromptSelector {
   renderDropdown() {
     const dropDown = EPSElementBuilder.dropDown(
       this.SELECT_ID,
-      Object.keys(this.tags), {
-        onChange: (selected) => {
-          const content = gradioApp().getElementById(this.CONTENT_ID)
-          Array.from(content.childNodes).forEach((node) => {
-            const visible = node.id === `easy-prompt-selector-container-${selected}`
-            this.changeVisibility(node, visible)
-          })
-        }
+      Object.keys(this.files), {
+        onChange: (selected) => { this.showFile(selected) }
       }
     )
 
     return dropDown
   }
 
+  // パネルは最初に選ばれたときに作る (作ったパネルは非表示にして残し、次からは表示を切り替えるだけ)
   renderContent() {
     const content = document.createElement('div')
     content.id = this.CONTENT_ID
 
-    Object.keys(this.tags).forEach((key) => {
-      const values = this.tags[key]
-
-      const fields = EPSElementBuilder.tagFields()
-      fields.id = `easy-prompt-selector-container-${key}`
-      fields.style.display = 'none'
-      fields.style.flexDirection = 'row'
-      fields.style.marginTop = '10px'
-
-      this.renderTagButtons(values, key).forEach((group) => {
-        fields.appendChild(group)
-      })
+    return content
+  }
 
-      content.appendChild(fields)
+  async showFile(name) {
+    const content = gradioApp().getElementById(this.CONTENT_ID)
+    let panel = null
+    Array.from(content.childNodes).forEach((node) => {
+      const visible = node.dataset.file === name
+      if (visible) { panel = node }
+      this.changeVisibility(node, visible)
     })
+    if (panel !== null || this.files[name] === undefined) { return }
+
+    panel = EPSElementBuilder.tagFields()
+    panel.id = `easy-prompt-selector-container-${name}`
+    panel.dataset.file = name
+    panel.style.flexDirection = 'row'
+    panel.style.marginTop = '10px'
+    panel.textContent = '読み込み中...'
+    content.appendChild(panel)
+
+    const values = await this.fetchFile(name)
+    if (values === undefined) {
+      // 次に選ばれたときに取得し直す
+      panel.textContent = '読み込みに失敗しました'
+      delete panel.dataset.file
+      return
+    }
 
-    return content
+    panel.textContent = ''
+    this.renderTagButtons(panel, values, name)
   }
 
-  renderTagButtons(tags, prefix = '') {
+  renderTagButtons(parent, tags, prefix = '') {
     if (Array.isArray(tags)) {
-      return tags.map((tag) => this.renderTagButton(tag, tag, 'secondary'))
+      this.appendLazily(parent, tags, (tag) => this.renderTagButton(stripWeight(tag), stripWeight(tag), 'secondary'))
     } else {
-      return Object.keys(tags).map((key) => {
+      this.appendLazily(parent, Object.keys(tags), (key) => {
         const values = tags[key]
         const randomKey = `${prefix}:${key}`
 
-        if (typeof values === 'string') { return this.renderTagButton(key, values, 'secondary') }
+        if (typeof values === 'string') { return this.renderTagButton(key, stripWeight(values), 'secondary') }
 
         const fields = EPSElementBuilder.tagFields()
         fields.style.flexDirection = 'column'
@@ -266,15 +294,36 @@ class EasyPromptSelector {
         const buttons = EPSElementBuilder.tagFields()
         buttons.id = 'buttons'
         fields.append(buttons)
-        this.renderTagButtons(values, randomKey).forEach((button) => {
-          buttons.appendChild(button)
-        })
+        this.renderTagButtons(buttons, values, randomKey)
 
         return fields
       })
     }
   }
 
+  // items を RENDER_CHUNK_SIZE 個ずつ描画する。末尾の目印がスクロールで見えたら続きを描画する
+  // (非表示のパネルの目印は見えないので、開かれていないファイルのボタンは作られない)
+  appendLazily(parent, items, render, start = 0) {
+    const stop = Math.min(start + this.RENDER_CHUNK_SIZE, items.length)
+    for (let i = start; i < stop; i++) {
+      parent.appendChild(render(items[i]))
+    }
+    if (stop >= items.length) { return }
+
+    const sentinel = document.createElement('div')
+    sentinel.style.flexBasis = '100%'
+    sentinel.style.height = '1px'
+    parent.appendChild(sentinel)
+
+    const observer = new IntersectionObserver((entries) => {
+      if (!entries.some((entry) => entry.isIntersecting)) { return }
+      observer.disconnect()
+      sentinel.remove()
+      this.appendLazily(parent, items, render, stop)
+    }, { rootMargin: '200px' })
+    observer.observe(sentinel)
+  }
+
   renderTagButton(title, value, color = 'primary') {
     return EPSElementBuilder.tagButton({
       title,
@@ -416,6 +465,9 @@ onUiLoaded(async () => {
     }
   });
 
+  // Python 側でタグを読み直した後に呼ばれる
+  window.easyPromptSelectorReloaded = () => easyPromptSelector.init();
+
   const reloadButton = gradioApp().getElementById('easy_prompt_selector_reload_button');
   const selectionModeRadio = gradioApp().getElementById('easy_prompt_selector_selection_mode_radio');
   const combinationCountHTML = gradioApp().getElementById('easy_prompt_selector_combination_count_html');
@@ -455,14 +507,8 @@ onUiLoaded(async () => {
           if (!promptInputGradioElement) console.error("EPS_JS_DEBUG: eps_prompt_textbox_input not found for update!");
       }
       
-      // easyPromptSelector.init() はタグファイルの再読み込みなどを行う
-      // プロンプトテキストの更新とは直接関係ないが、リロード処理の一部
-      await easyPromptSelector.init(); 
-      
-      // 注意: この JavaScript の click リスナーが完了した後、Gradio のイベントキューを介して
-      // Python 側の reload_button.click(...) に登録された関数が呼び出される。
-      // その際、inputs=[..., prompt_textbox_input] で参照される値は、
-      // 上記の dispatchEvent('input') によって Gradio 側で更新された後の値になることを期待する。
+      // タグ表示の作り直し (easyPromptSelector.init()) は、Python 側の読み直しが終わった後に
+      // easyPromptSelectorReloaded() から行う (reload_button.click(...).then(...) を参照)
     });
   } else {
     console.error("EasyPromptSelector: Reload button (easy_prompt_selector_reload_button) not found!");
@@ -511,23 +557,32 @@ onUiLoaded(async () => {
   await easyPromptSelector.init(); // 初期ロード
 
   // メインプロンプトエリアの変更を監視し、隠しテキストボックスに値を同期する
+  // 入力が止まるまで待ち (debounce)、テンプレート部分が変わったときだけ Python 側に通知する
   const mainPromptTextareaForSync = gradioApp().querySelector("#txt2img_prompt textarea") || gradioApp().querySelector("#img2img_prompt textarea");
   if (mainPromptTextareaForSync && promptInputGradioElement) {
-      mainPromptTextareaForSync.addEventListener('input', () => {
+      const COUNT_UPDATE_DELAY_MS = 300;
+      const templateSignature = (text) => (text.match(/@((\d+(-\d+)?)!?\$\$)?[^>]+?@/g) || []).join('\n');
+      let lastSignature = null;
+      let pendingUpdate = null;
+
+      const syncPromptInput = () => {
+          pendingUpdate = null;
+          const signature = templateSignature(mainPromptTextareaForSync.value);
+          if (signature === lastSignature) { return; } // テンプレートが同じなら組み合わせ数も同じ
+          lastSignature = signature;
+
           promptInputGradioElement.value = mainPromptTextareaForSync.value;
           // input イベントを発行して Gradio 側 (Python の .input() リスナー) にも変更を通知
           promptInputGradioElement.dispatchEvent(new Event('input', { bubbles: true, cancelable: true }));
-          
-          // combinationCountHTML の表示を "Calculating..." に戻す処理はここでも良いが、
-          // Python側の .input() リスナーがHTMLを更新するので、二重管理になる可能性。
-          // JavaScript側で直接 "Calculating..." にするなら、Python側でのHTML更新を調整する必要がある。
-          // if (combinationCountHTML) {
-          //   combinationCountHTML.innerHTML = "Combinations: Calculating...";
-          // }
+      };
+
+      mainPromptTextareaForSync.addEventListener('input', () => {
+          // 待機中の古い更新は捨てて、最新のテキストだけを送る
+          if (pendingUpdate !== null) { clearTimeout(pendingUpdate); }
+          pendingUpdate = setTimeout(syncPromptInput, COUNT_UPDATE_DELAY_MS);
       });
       // 初期ロード時にも一度値を同期しておく
-      promptInputGradioElement.value = mainPromptTextareaForSync.value;
-      promptInputGradioElement.dispatchEvent(new Event('input', { bubbles: true, cancelable: true }));
+      syncPromptInput();
 
   } else {
       if (!mainPromptTextareaForSync) console.error("EPS_JS_DEBUG: Main prompt textarea not found for sync event listener!");
@@ -0,0 +1 @@
+"""EasyPromptSelector のテンプレートエンジン (WebUI に依存しない部分)"""
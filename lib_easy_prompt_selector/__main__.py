@@ -0,0 +1,3 @@
+from lib_easy_prompt_selector.cli import main
+
+main()
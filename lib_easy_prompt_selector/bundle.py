@@ -0,0 +1,69 @@
+"""ブラウザ向けのタグバンドル (パース済みのタグを 1 つの JSON にまとめたもの) と差分"""
+import gzip
+import hashlib
+import json
+
+BUNDLE_HISTORY_SIZE = 16
+
+
+def encode_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+def digest(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=12).hexdigest()
+
+
+class TagBundle:
+    """TagLibrary 1 つ分の JSON と、過去のバージョンとの差分を作るための情報
+
+    version はファイル名と各ファイルの内容から決まるので、そのまま ETag に使える。
+    """
+
+    def __init__(self, library, previous=None):
+        self.library_version = library.version
+        self.files = {}    # ファイル名 -> JSON 文字列
+        self.digests = {}  # ファイル名 -> JSON のハッシュ
+        for name, data in library.items():
+            previous_text = previous.files.get(name) if previous is not None else None
+            text = encode_json(data)
+            self.files[name] = text
+            self.digests[name] = previous.digests[name] if text == previous_text else digest(text)
+        self.version = digest(encode_json(list(self.digests.items())))
+
+        # 差分を返せる過去のバージョン -> その時点の digests
+        self.history = dict(previous.history) if previous is not None else {}
+        if previous is not None and previous.version != self.version:
+            self.history[previous.version] = previous.digests
+        while len(self.history) > BUNDLE_HISTORY_SIZE:
+            del self.history[next(iter(self.history))]
+
+        self.body = self.render(self.files, [])
+        self.gzip_body = gzip.compress(self.body, mtime=0)
+        # ブラウザが最初に取得するファイルの一覧 (ファイル名 -> ハッシュ)。各ファイルの中身は開いたときに file_body で取得する
+        self.index_body = encode_json({'version': self.version, 'files': self.digests}).encode('utf-8')
+        self._gzip_files = {}
+
+    def file_body(self, name, compressed=False):
+        """1 ファイル分の JSON。圧縮したものは最初に要求されたときに作って保持する"""
+        body = self.files[name].encode('utf-8')
+        if not compressed:
+            return body
+        gzip_body = self._gzip_files.get(name)
+        if gzip_body is None:
+            gzip_body = self._gzip_files[name] = gzip.compress(body, mtime=0)
+        return gzip_body
+
+    def render(self, files, removed, since=None):
+        parts = [f'"{encode_json(name)[1:-1]}":{text}' for name, text in files.items()]
+        header = f'"version":"{self.version}"' + (f',"since":"{since}"' if since else '')
+        return f'{{{header},"files":{{{",".join(parts)}}},"removed":{encode_json(removed)}}}'.encode('utf-8')
+
+    def delta(self, since):
+        """since のバージョンからの差分 JSON。since を知らない場合は None (全体を返すこと)"""
+        old_digests = self.history.get(since)
+        if old_digests is None:
+            return None
+        changed = {name: text for name, text in self.files.items() if old_digests.get(name) != self.digests[name]}
+        removed = [name for name in old_digests if name not in self.files]
+        return self.render(changed, removed, since)
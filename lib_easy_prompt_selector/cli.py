@@ -0,0 +1,128 @@
+"""プロンプトの一括展開 (WebUI なしで使うコマンドライン)
+
+    python -m lib_easy_prompt_selector "1girl, @hair:Color@ hair" --mode round_robin --start 0 --stop 1000000 -o sweep.jsonl
+    python -m lib_easy_prompt_selector "@3$$animal:Cute@" --mode random --seed 1234 --stop 10000
+    python -m lib_easy_prompt_selector "1girl, @hair:Color@ hair" --mode shuffle --stop 100
+
+1 行に 1 つ {"index": ..., "seed": ..., "prompt": ...} を JSONL で出力する。
+ラウンドロビンの index は組み合わせの番号 (組み合わせ数を超えたら先頭に戻る)。
+シャッフルの index は WebUI のシャッフルモードの進捗の位置で、同じタグなら WebUI と同じ順番になる。
+ランダムの seed は WebUI と同じく --seed + index で、--salt が同じなら WebUI のランダムモードと同じ展開になる。
+インデックスの範囲を --chunk-size ごとに分けてプロセスプールで展開し、順番どおりに書き出す。
+同時に処理中のチャンクの数を制限するので、出力の件数によらずメモリ使用量は一定。
+"""
+from collections import deque
+from contextlib import redirect_stdout
+from pathlib import Path
+import argparse
+import multiprocessing
+import os
+import sys
+
+from lib_easy_prompt_selector.engine import count_combinations, format_combination_count
+from lib_easy_prompt_selector.preview import DEFAULT_SALT, MODES, Expander
+from lib_easy_prompt_selector.tags import TagLoader
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def load_library(tags_dir=None):
+    """タグを読み込む。tags_dir を省略すると拡張機能の tags とキャッシュを使う
+
+    load_tags と違い、WebUI 側のファイル一覧 (tmp/easyPromptSelector.txt) は書き換えない。
+    読み込み時のメッセージは標準出力の JSONL に混ざらないよう標準エラー出力に出す。
+    """
+    with redirect_stdout(sys.stderr):
+        if tags_dir is None:
+            from lib_easy_prompt_selector.store import CACHE_FILE, TAGS_DIR
+            return TagLoader(TAGS_DIR, cache_file=CACHE_FILE).load()
+        return TagLoader(Path(tags_dir)).load()
+
+
+def chunk_ranges(start, stop, step, size):
+    """[start, stop) を step 刻みで size 個ずつに分けた (start, stop, step) を返す。巨大な範囲でも len() は使わない"""
+    span = step * size
+    while start < stop:
+        end = min(start + span, stop)
+        yield start, end, step
+        start = end
+
+
+_worker_expander = None
+
+
+def _init_worker(tags, prompt, mode, seed, salt):
+    # タグは親プロセスで読み込んだものを受け取る (ワーカーではファイルを読まない)
+    global _worker_expander
+    _worker_expander = Expander(tags, prompt, mode, seed, salt)
+
+
+def _render_chunk(chunk):
+    return _worker_expander.render(*chunk)
+
+
+def expand_to(output, expander, chunks, workers, init_args):
+    """チャンクを展開して output に順番どおり書き出す。書いた件数を返す"""
+    written = 0
+    if workers <= 1:
+        for chunk in chunks:
+            output.write(expander.render(*chunk))
+            written += len(range(*chunk))
+        return written
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=_init_worker, initargs=init_args) as pool:
+        pending = deque()
+        for chunk in chunks:
+            # 書き出しが追いつかない場合に結果が溜まらないよう、処理中のチャンクは workers の 2 倍まで
+            if len(pending) >= workers * 2:
+                output.write(pending.popleft().get())
+            pending.append(pool.apply_async(_render_chunk, (chunk,)))
+            written += len(range(*chunk))
+        while pending:
+            output.write(pending.popleft().get())
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lib_easy_prompt_selector', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('prompt')
+    parser.add_argument('--mode', choices=MODES, default='round_robin')
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--stop', type=int, default=None, help="end of the index range (default: the number of combinations in round_robin and shuffle mode)")
+    parser.add_argument('--step', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None, help="base seed; image i uses seed + i (random mode without a seed is not reproducible)")
+    parser.add_argument('--salt', default=DEFAULT_SALT, help=f"prompt field name mixed into the random seed (default: {DEFAULT_SALT!r})")
+    parser.add_argument('--tags-dir', default=None, help="tag directory (default: the extension's tags)")
+    parser.add_argument('-o', '--output', default=None, help="output file (default: stdout)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.step <= 0:
+        parser.error("--step must be positive")
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be positive")
+
+    tags = load_library(args.tags_dir)
+    try:
+        expander = Expander(tags, args.prompt, args.mode, args.seed, args.salt)
+    except ValueError as e:
+        parser.error(str(e))
+
+    stop = args.stop
+    if stop is None:
+        if args.mode == 'random':
+            parser.error("--stop is required in random mode")
+        stop = expander.total
+    print(f"[EasyPromptSelector] Combinations: {format_combination_count(count_combinations(tags, args.prompt))}", file=sys.stderr)
+
+    chunks = chunk_ranges(args.start, stop, args.step, args.chunk_size)
+    init_args = (tags, args.prompt, args.mode, args.seed, args.salt)
+    if args.output is None:
+        written = expand_to(sys.stdout.buffer, expander, chunks, args.workers, init_args)
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.output, 'wb') as output:
+            written = expand_to(output, expander, chunks, args.workers, init_args)
+    print(f"[EasyPromptSelector] Wrote {written} prompts", file=sys.stderr)
@@ -0,0 +1,168 @@
+"""ラウンドロビンの進捗 (プロンプトごとの次のインデックス) の永続化
+
+進捗は SQLite (WAL) に保存するので、再起動後も続きから再開でき、複数のワーカーで同じ全組み合わせを分担できる。
+インデックスはジョブの画像数ぶんをまとめて予約し (リース)、ジョブが終わったら解放する。
+ジョブの途中でプロセスが落ちた場合、そのリースは期限切れ後に次に予約したワーカーへ同じ範囲が渡される。
+"""
+from typing import NamedTuple
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# リースの有効期間 (秒)。バッチごとに延長する
+LEASE_SECONDS = 600
+
+
+def cursor_key(prompt, library_digest, scope=''):
+    """プロンプトとタグの内容 (と scope) から進捗のキーを作る。タグの内容が変われば別の進捗になる"""
+    hasher = hashlib.blake2b(digest_size=16, person=b'eps-cursor')
+    for part in (scope, library_digest, prompt):
+        data = part.encode('utf-8')
+        hasher.update(len(data).to_bytes(8, 'little'))
+        hasher.update(data)
+    return hasher.hexdigest()
+
+
+class Lease(NamedTuple):
+    """予約したインデックスの範囲 [start, stop)"""
+    id: int
+    key: str
+    start: int
+    stop: int
+
+
+class CursorStore:
+    """キーごとの次のインデックスと、予約中の範囲 (リース) を保存する
+
+    path が None の場合や開けない場合はメモリ上のデータベースを使う (再起動すると最初から)。
+    """
+
+    def __init__(self, path=None, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def connect(self):
+        if self._connection is not None:
+            return self._connection
+
+        connection = None
+        if self.path is not None:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                connection = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+                self.create_tables(connection)
+            except (OSError, sqlite3.Error) as e:
+                print(f"[EasyPromptSelector] Round robin progress will not be saved ({self.path}): {e}")
+                connection = None
+        if connection is None:
+            connection = sqlite3.connect(':memory:', isolation_level=None, check_same_thread=False)
+            self.create_tables(connection)
+        self._connection = connection
+        return connection
+
+    @staticmethod
+    def create_tables(connection):
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS cursors (
+                key TEXT PRIMARY KEY,
+                next_index INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                stop INTEGER NOT NULL,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS leases_key ON leases (key, expires_at);
+        ''')
+
+    def reserve(self, key, count):
+        """key のインデックスを count 個予約する
+
+        期限切れのリースがあればその範囲を先に引き継ぐので、戻り値の範囲が count より短いことがある。
+        足りない分は呼び出し側が再度 reserve する。
+        """
+        now = time.time()
+        with self._lock:
+            connection = self.connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                expired = connection.execute(
+                    'SELECT id, start, stop FROM leases WHERE key = ? AND expires_at < ? ORDER BY start LIMIT 1',
+                    (key, now),
+                ).fetchone()
+                if expired is not None:
+                    lease_id, start, stop = expired
+                    if stop - start > count:
+                        # 引き継ぐのは必要な分だけにして、残りは期限切れのまま次の予約に回す
+                        connection.execute('UPDATE leases SET start = ? WHERE id = ?', (start + count, lease_id))
+                        stop = start + count
+                        lease_id = connection.execute(
+                            'INSERT INTO leases (key, start, stop, owner, expires_at) VALUES (?, ?, ?, ?, ?)',
+                            (key, start, stop, self.owner, now + self.lease_seconds),
+                        ).lastrowid
+                    else:
+                        connection.execute(
+                            'UPDATE leases SET owner = ?, expires_at = ? WHERE id = ?',
+                            (self.owner, now + self.lease_seconds, lease_id),
+                        )
+                else:
+                    row = connection.execute('SELECT next_index FROM cursors WHERE key = ?', (key,)).fetchone()
+                    start = row[0] if row is not None else 0
+                    stop = start + count
+                    connection.execute(
+                        'INSERT INTO cursors (key, next_index, updated_at) VALUES (?, ?, ?) '
+                        'ON CONFLICT (key) DO UPDATE SET next_index = excluded.next_index, updated_at = excluded.updated_at',
+                        (key, stop, now),
+                    )
+                    lease_id = connection.execute(
+                        'INSERT INTO leases (key, start, stop, owner, expires_at) VALUES (?, ?, ?, ?, ?)',
+                        (key, start, stop, self.owner, now + self.lease_seconds),
+                    ).lastrowid
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return Lease(lease_id, key, start, stop)
+
+    def reserve_indexes(self, key, count):
+        """count 個のインデックスと、そのためのリースのリストを返す"""
+        indexes = []
+        leases = []
+        while len(indexes) < count:
+            lease = self.reserve(key, count - len(indexes))
+            leases.append(lease)
+            indexes.extend(range(lease.start, lease.stop))
+        return indexes, leases
+
+    def renew(self, leases):
+        """処理中のリースの期限を延ばす"""
+        if not leases:
+            return
+        expires_at = time.time() + self.lease_seconds
+        with self._lock:
+            self.connect().executemany('UPDATE leases SET expires_at = ? WHERE id = ?', [(expires_at, lease.id) for lease in leases])
+
+    def complete(self, leases):
+        """処理が終わったリースを解放する"""
+        if not leases:
+            return
+        with self._lock:
+            self.connect().executemany('DELETE FROM leases WHERE id = ?', [(lease.id,) for lease in leases])
+
+    def position(self, key):
+        """key の次に予約されるインデックス (まだなければ 0)"""
+        with self._lock:
+            row = self.connect().execute('SELECT next_index FROM cursors WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else 0
@@ -0,0 +1,451 @@
+"""組み合わせ数の計算と、ラウンドロビン・ランダムでのテンプレート展開"""
+from bisect import bisect_right
+from functools import lru_cache
+from typing import NamedTuple
+import math
+
+from lib_easy_prompt_selector.metrics import NULL_TIMER, metrics
+from lib_easy_prompt_selector.rng import AliasTable, FeistelPermutation, StableRandom
+from lib_easy_prompt_selector.tags import find_tag_options
+from lib_easy_prompt_selector.templates import Template, compile_prompt, parse_prompt, parse_weighted_option
+
+SELECTION_ORDERED_WITH_REPEATS = "ordered with repeats"
+SELECTION_DISTINCT = "distinct, unordered"
+COUNT_CACHE_SIZE = 1024
+
+
+class TemplateCount(NamedTuple):
+    template: str
+    count: int
+    selection: str
+
+
+class CombinationCount(NamedTuple):
+    """組み合わせ数の内訳。error がある場合 total は 0"""
+    total: int
+    templates: tuple = ()
+    error: str = None
+
+
+@lru_cache(maxsize=COUNT_CACHE_SIZE)
+def template_combinations_count(options_count, min_count, max_count):
+    # 各位置で独立して選択する (重複あり・順序あり) ので、個数 k ごとに options_count ** k 通り
+    # その和 n^min + ... + n^max を等比級数の公式で求める
+    if min_count > max_count:
+        return 0
+    if options_count == 0:
+        return 1 if min_count == 0 else 0
+    if options_count == 1:
+        return max_count - min_count + 1
+    return (options_count ** (max_count + 1) - options_count ** min_count) // (options_count - 1)
+
+
+class TagNode(NamedTuple):
+    """タグパスの選択肢と、選択肢に含まれるテンプレートを展開した場合の選び方の数
+
+    expansions[i] は選択肢 i のテンプレート (CompiledPrompt, Slot のタプル)。テンプレートを含まなければ None。
+    選択肢 i の展開後の選び方の数は cumulative[i] - cumulative[i - 1]。
+    sampler は "3::value" で重みが指定されている場合のランダム選択用の別名表 (重みがなければ None で一様に選ぶ)。
+    subsets は重複なしの選択 (@n!$$...@) の数え上げ表のキャッシュ (distinct_subset_count を参照)。
+    """
+    options: tuple
+    expansions: tuple
+    cumulative: tuple
+    total: int
+    sampler: AliasTable = None
+    subsets: dict = None
+
+
+class Slot(NamedTuple):
+    """テンプレート 1 つ分の選択肢。error がある場合は error をそのまま出力する"""
+    template: Template
+    node: TagNode
+    count: int
+    error: str = None
+
+
+def derived_cache(tags, name, maxsize=None):
+    """tags.derived の中の名前付きキャッシュを返す。maxsize に達したら作り直す
+
+    複数のスレッドから同じライブラリを使うので、キャッシュの作成と差し替えは 1 回の代入で行う。
+    同じ値を二重に計算することはあっても、途中の状態が見えることはない。
+    """
+    cache = tags.derived.setdefault(name, {})
+    if maxsize is not None and len(cache) >= maxsize:
+        cache = tags.derived[name] = {}
+    return cache
+
+
+def resolve_node(tags, ref):
+    """ref の TagNode を返す (タグのバージョンごとにメモ化)。エラー時はエラー文字列を返す
+
+    ネストした参照は再帰的に解決する。循環は読み込み時に検出済みなので、循環に含まれるパスはここでエラーにする。
+    """
+    nodes = derived_cache(tags, 'nodes')
+    node = nodes.get(ref)
+    if node is None:
+        node = nodes[ref] = build_node(tags, ref)
+    return node
+
+
+def build_node(tags, ref):
+    if ref in tags.cyclic:
+        # 呼び出し側で "Error: " を付ける (find_tag_options のエラーと違い、ここでは付けない)
+        return f"circular reference in tag '{':'.join(ref)}'"
+
+    options = find_tag_options(tags, ref)
+    if "Error:" in options[0]:
+        return options[0]
+
+    weights, options = zip(*map(parse_weighted_option, options))
+    sampler = None
+    if any(weight != 1 for weight in weights) and sum(weights) > 0:
+        sampler = AliasTable(weights)
+
+    expansions = []
+    cumulative = []
+    total = 0
+    for option in options:
+        expansion = None
+        weight = 1
+        if '@' in option:
+            compiled = parse_prompt(option)
+            if compiled.templates:
+                slots = tuple(resolve_slot(tags, template_info) for template_info in compiled.templates)
+                expansion = (compiled, slots)
+                for slot in slots:
+                    weight *= slot.count
+        expansions.append(expansion)
+        total += weight
+        cumulative.append(total)
+    return TagNode(options, tuple(expansions), tuple(cumulative), total, sampler, {})
+
+
+def option_weight(node, position):
+    """選択肢 position の展開後の選び方の数"""
+    return node.cumulative[position] - node.cumulative[position - 1] if position else node.cumulative[0]
+
+
+def distinct_subset_count(node, start, size):
+    """start 番目以降の選択肢から異なる size 個を選ぶ場合の、展開を含めた選び方の数
+
+    ネストがなければ math.comb。ネストがある場合は各選択肢の展開数の基本対称式になるので、
+    後ろから累積した表を size ごとに作って node.subsets にキャッシュする。
+    """
+    options_count = len(node.options)
+    if node.total == options_count:
+        return math.comb(options_count - start, size)
+
+    rows = node.subsets
+    if size not in rows:
+        if size == 0:
+            rows[0] = [1] * (options_count + 1)
+        else:
+            previous = [distinct_subset_count(node, i, size - 1) for i in range(options_count + 1)]
+            row = [0] * (options_count + 1)
+            for i in range(options_count - 1, -1, -1):
+                row[i] = row[i + 1] + option_weight(node, i) * previous[i + 1]
+            rows[size] = row
+    return rows[size][start]
+
+
+def not_enough_tags(node, template_info):
+    """選択肢より多く選ぶテンプレートのエラー文字列。足りている場合は None"""
+    if len(node.options) >= template_info.max_count:
+        return None
+    requested = max(template_info.min_count, len(node.options) + 1)
+    return f"Error: not enough tags for '{':'.join(template_info.ref)}' (requested {requested}, but only {len(node.options)} available)"
+
+
+def slot_count(node, template_info):
+    min_count, max_count = template_info.min_count, template_info.max_count
+    if template_info.distinct:
+        return sum(distinct_subset_count(node, 0, size) for size in range(min_count, max_count + 1))
+    return template_combinations_count(node.total, min_count, max_count)
+
+
+def resolve_slot(tags, template_info):
+    # ネストしたテンプレートのエラーは選択肢全体を無効にせず、エラー文字列をそのまま出力する
+    node = resolve_node(tags, template_info.ref)
+    if isinstance(node, str):
+        return Slot(template_info, None, 1, node if "Error:" in node else "Error: " + node)
+    # 重複なしで選択肢より多くは選べないので、ネストやランダムでもトップレベルのラウンドロビンと同じエラーにする
+    error = not_enough_tags(node, template_info) if template_info.distinct else None
+    if error:
+        return Slot(template_info, None, 1, error)
+    return Slot(template_info, node, slot_count(node, template_info))
+
+
+def resolve_templates(tags, parsed_templates):
+    """各テンプレートの Slot のリストを返す。エラー時はエラー文字列を返す"""
+    resolved_cache = derived_cache(tags, 'slots', COUNT_CACHE_SIZE)
+    resolved = resolved_cache.get(parsed_templates)
+    if metrics.enabled:
+        metrics.cache_lookup('slots', resolved is not None)
+    if resolved is not None:
+        return resolved
+
+    resolved = []
+    for template_info in parsed_templates:
+        node = resolve_node(tags, template_info.ref)
+        if isinstance(node, str):
+            resolved = "Error: " + node
+            break
+
+        error = not_enough_tags(node, template_info)
+        if error:
+            resolved = error
+            break
+
+        resolved.append(Slot(template_info, node, slot_count(node, template_info)))
+
+    resolved_cache[parsed_templates] = resolved
+    return resolved
+
+
+def count_combinations(tags, prompt):
+    """プロンプト全体の組み合わせ数と、テンプレートごとの内訳を返す (タグのバージョンごとにキャッシュ)
+
+    ネストしたテンプレートを含む選択肢は、その展開の数だけ別の組み合わせとして数える。
+    """
+    if not '@' in prompt:
+        return CombinationCount(1)
+
+    templates = compile_prompt(prompt).templates
+    counts = derived_cache(tags, 'counts', COUNT_CACHE_SIZE)
+    cached = counts.get(templates)
+    if metrics.enabled:
+        metrics.cache_lookup('counts', cached is not None)
+    if cached is not None:
+        return cached
+
+    resolved = resolve_templates(tags, templates)
+    if isinstance(resolved, str):
+        result = CombinationCount(0, error=resolved)
+    else:
+        total_combinations = 1
+        for slot in resolved:
+            total_combinations *= slot.count
+        result = CombinationCount(total_combinations, tuple(
+            TemplateCount(slot.template.template, slot.count, SELECTION_DISTINCT if slot.template.distinct else SELECTION_ORDERED_WITH_REPEATS)
+            for slot in resolved
+        ))
+
+    counts[templates] = result
+    return result
+
+
+def calculate_combinations_count(tags, prompt):
+    result = count_combinations(tags, prompt)
+    return result.error or result.total
+
+
+def format_count(count):
+    """組み合わせ数を表示用に整形する。桁数が多い場合は指数表記 (巨大な整数の文字列化は避ける)"""
+    if count < 10 ** 15:
+        return f"{count:,}"
+    exponent = int(math.log10(count))
+    # log10 の丸め誤差で 1 ずれることがあるので、整数の比較で 10 ** exponent <= count < 10 ** (exponent + 1) に合わせる
+    while 10 ** exponent > count:
+        exponent -= 1
+    while 10 ** (exponent + 1) <= count:
+        exponent += 1
+    leading = count // 10 ** (exponent - 2)
+    return f"{leading / 100:.2f}e+{exponent}"
+
+
+def format_combination_count(result):
+    if result.error:
+        return result.error
+    text = format_count(result.total)
+    if len(result.templates) > 1:
+        # どのテンプレートが組み合わせ数を増やしているか分かるように内訳を付ける
+        largest = max(result.templates, key=lambda template_count: template_count.count)
+        text += f" (largest: {largest.template} = {format_count(largest.count)}, {largest.selection})"
+    elif result.templates:
+        text += f" ({result.templates[0].selection})"
+    return text
+
+
+def decode_node(node, index):
+    """node の index 番目の展開を返す。選択肢は重み (展開の数) の累積和を二分探索して決める"""
+    position = bisect_right(node.cumulative, index)
+    if position:
+        index -= node.cumulative[position - 1]
+    return decode_option(node, position, index)
+
+
+def decode_option(node, position, index):
+    """選択肢 position の index 番目の展開を返す"""
+    expansion = node.expansions[position]
+    if expansion is None:
+        return node.options[position]
+    compiled, slots = expansion
+    return compiled.substitute(combination_at(slots, index))
+
+
+def decode_distinct_selection(node, size, index):
+    """異なる size 個の選択肢の組の index 番目を返す (組合せ数系による辞書順の逆引き)
+
+    選択肢 i を先頭に含む組は option_weight(i) * (i より後ろから size - 1 個選ぶ数) 個あるので、
+    先頭から順にその個数を引いていく。選んだ選択肢はタグファイルでの順に並ぶ。
+    """
+    selected = []
+    start = 0
+    for remaining in range(size, 0, -1):
+        for position in range(start, len(node.options)):
+            rest = distinct_subset_count(node, position + 1, remaining - 1)
+            block = option_weight(node, position) * rest
+            if index < block:
+                option_index, index = divmod(index, rest)
+                selected.append(decode_option(node, position, option_index))
+                start = position + 1
+                break
+            index -= block
+    return ', '.join(selected)
+
+
+def decode_template_selection(slot, index):
+    """テンプレート内の index 番目の選び方を返す (個数の少ない順、先頭の位置ほど上位の桁)"""
+    if slot.error:
+        return slot.error
+    min_count, max_count = slot.template.min_count, slot.template.max_count
+    if slot.template.distinct:
+        for size in range(min_count, max_count + 1):
+            block = distinct_subset_count(slot.node, 0, size)
+            if index < block:
+                return decode_distinct_selection(slot.node, size, index)
+            index -= block
+        raise IndexError(f"selection index out of range for '{slot.template.template}'")
+
+    total = slot.node.total
+    for count in range(min_count, max_count + 1):
+        block = total ** count
+        if index < block:
+            selected = []
+            for _ in range(count):
+                index, digit = divmod(index, total)
+                selected.append(decode_node(slot.node, digit))
+            return ', '.join(reversed(selected))
+        index -= block
+    raise IndexError(f"selection index out of range for '{slot.template.template}'")
+
+
+def combination_at(resolved, index):
+    """resolve_templates の結果 (Slot のリスト) から index 番目の組み合わせを復元する (混合基数表現)
+
+    最後のテンプレートが最も速く変化する。全組み合わせを列挙せずに任意の位置へ移動できる。
+    """
+    selection = [None] * len(resolved)
+    for position in range(len(resolved) - 1, -1, -1):
+        slot = resolved[position]
+        index, digit = divmod(index, slot.count)
+        selection[position] = decode_template_selection(slot, digit)
+    return selection
+
+
+@lru_cache(maxsize=COUNT_CACHE_SIZE)
+def shuffle_permutation(total, prompt, library_digest):
+    """シャッフルモードの並べ替え (進捗の位置 -> 組み合わせの番号)
+
+    プロンプトとタグの内容から鍵を作るので、再起動後や別のワーカーでも同じ順番になる。
+    """
+    return FeistelPermutation(total, 'shuffle', library_digest, prompt)
+
+
+def generate_combinations(tags, parsed_templates):
+    """全組み合わせを順に返すジェネレータ。リストは構築しない"""
+    resolved = resolve_templates(tags, parsed_templates)
+    if isinstance(resolved, str):
+        yield [resolved] * len(parsed_templates)
+        return
+
+    total_combinations = 1
+    for slot in resolved:
+        total_combinations *= slot.count
+
+    for index in range(total_combinations):
+        yield combination_at(resolved, index)
+
+
+def draw_random_replacements(slots, rng):
+    """各テンプレートの置換文字列を選ぶ
+
+    テンプレートごとに位置で分けた乱数列を使うので、あるテンプレートの選択が他の選択に影響しない。
+    選んだ選択肢がテンプレートを含む場合は、その乱数列から更に分けた乱数列で続けて展開する。
+    重複なしのテンプレートは非復元抽出し、タグファイルでの順に並べる。
+    """
+    replacements = []
+    for position, slot in enumerate(slots):
+        stream = rng.substream(position)
+        if slot.error:
+            num_to_select = stream.randint(slot.template.min_count, slot.template.max_count)
+            replacements.append(slot.error if num_to_select else '') # エラーメッセージを追加
+            continue
+
+        node = slot.node
+        num_to_select = stream.randint(slot.template.min_count, slot.template.max_count)
+        if slot.template.distinct:
+            if node.sampler is None:
+                picks = sorted(stream.sample(range(len(node.options)), num_to_select))
+            else:
+                picks = sorted(node.sampler.sample_distinct(stream, num_to_select))
+        elif node.sampler is None:
+            picks = stream.choices(range(len(node.options)), k=num_to_select)
+        else:
+            picks = node.sampler.sample(stream, num_to_select)
+        selected = []
+        for pick, option_index in enumerate(picks):
+            expansion = node.expansions[option_index]
+            if expansion is None:
+                selected.append(node.options[option_index])
+            else:
+                compiled, nested_slots = expansion
+                selected.append(compiled.substitute(draw_random_replacements(nested_slots, stream.substream(pick))))
+        replacements.append(', '.join(selected))
+    return replacements
+
+
+def expand_random(tags, prompt, rng):
+    # ネストしたテンプレート (タグの値に含まれる @...@) は解決済みの TagNode をたどって一度に展開する
+    if not '@' in prompt:
+        return prompt
+    compiled = compile_prompt(prompt)
+    slots = [resolve_slot(tags, template_info) for template_info in compiled.templates]
+    return compiled.substitute(draw_random_replacements(slots, rng))
+
+
+def image_random(seed, salt=None):
+    """画像のシードとフィールド名から乱数生成器を作る。シードが無い場合は毎回異なる"""
+    return StableRandom(seed, salt) if seed is not None else StableRandom()
+
+
+def replace_template_random(tags, prompt, seed = None, salt = None):
+    # グローバルの random の状態は変えず、シードから導いた専用の乱数生成器を使う
+    return expand_random(tags, prompt, image_random(seed, salt))
+
+
+def replace_template_random_batch(tags, prompts, seeds, salt=None, timer=NULL_TIMER):
+    """prompts[i] を seeds[i] (と salt) から導いた乱数で展開したリストを返す
+
+    同じプロンプトはまとめて、解析と選択肢の参照を一度だけ行う。
+    各画像の選択はその画像のシードだけで決まるので、他の画像を展開せずに再現できる。
+    timer には段階ごとの所要時間を記録する (metrics.JobTimer)。
+    """
+    results = list(prompts)
+    groups = {}
+    for i, prompt in enumerate(prompts):
+        if '@' in prompt:
+            groups.setdefault(prompt, []).append(i)
+
+    for prompt, indexes in groups.items():
+        with timer.stage('parse'):
+            compiled = compile_prompt(prompt)
+            slots = [resolve_slot(tags, template_info) for template_info in compiled.templates]
+        for i in indexes:
+            rng = image_random(seeds[i] if i < len(seeds) else None, salt)
+            with timer.stage('generate'):
+                replacements = draw_random_replacements(slots, rng)
+            with timer.stage('substitute'):
+                results[i] = compiled.substitute(replacements)
+    return results
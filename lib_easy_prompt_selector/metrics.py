@@ -0,0 +1,154 @@
+"""プロンプト展開の各段階の計測と、Prometheus 形式での出力
+
+計測は設定で有効にしたときだけ行う。無効の場合、各段階の計測は何もしないコンテキストマネージャになる。
+"""
+from collections import defaultdict
+from contextlib import nullcontext
+import math
+import threading
+import time
+
+STAGES = ('load', 'parse', 'count', 'generate', 'substitute')
+
+
+class JobTimer:
+    """1 つのジョブの段階ごとの所要時間を集計する"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def summary(self):
+        """EPS Timing に書き込む文字列 (ミリ秒)"""
+        return ', '.join(f"{name}: {self.seconds[name] * 1000:.2f}ms" for name in STAGES if name in self.seconds)
+
+
+class _Stage:
+    __slots__ = ('timer', 'name', 'started')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timer.seconds[self.name] += time.perf_counter() - self.started
+        self.timer.calls[self.name] += 1
+
+
+class NullTimer:
+    """計測が無効なときの JobTimer の代わり"""
+    _stage = nullcontext()
+
+    def stage(self, name):
+        return self._stage
+
+    def summary(self):
+        return ''
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """プロセス全体の累計。enabled が False の間は何も記録しない"""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        self.cache_requests = defaultdict(int)  # (キャッシュ名, 'hit' | 'miss') -> 回数
+        self.jobs = 0
+        self.combination_space_log10 = {}  # フィールド名 -> 直近のジョブの組み合わせ数の log10
+        self.max_prompt_list_size = 0
+        self.max_options_size = 0
+
+    def timer(self):
+        """ジョブ用のタイマー。無効なら何もしない NULL_TIMER"""
+        return JobTimer() if self.enabled else NULL_TIMER
+
+    def cache_lookup(self, cache, hit):
+        with self._lock:
+            self.cache_requests[cache, 'hit' if hit else 'miss'] += 1
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+            self.stage_calls[stage] += 1
+
+    def record_job(self, timer, combination_counts=None, prompt_list_size=0, options_size=0):
+        """ジョブの計測結果を累計に加える。combination_counts はフィールド名 -> 組み合わせ数"""
+        if not isinstance(timer, JobTimer):
+            return
+        with self._lock:
+            self.jobs += 1
+            for stage, seconds in timer.seconds.items():
+                self.stage_seconds[stage] += seconds
+                self.stage_calls[stage] += timer.calls[stage]
+            for field, count in (combination_counts or {}).items():
+                self.combination_space_log10[field] = math.log10(count) if count > 0 else 0.0
+            self.max_prompt_list_size = max(self.max_prompt_list_size, prompt_list_size)
+            self.max_options_size = max(self.max_options_size, options_size)
+
+    def render(self, lru_caches=()):
+        """Prometheus のテキスト形式で出力する。lru_caches は (名前, lru_cache された関数) の並び"""
+        cache_requests = dict(self.cache_requests)
+        for name, function in lru_caches:
+            info = function.cache_info()
+            cache_requests[name, 'hit'] = info.hits
+            cache_requests[name, 'miss'] = info.misses
+
+        lines = [
+            '# HELP eps_enabled Whether EasyPromptSelector metrics are being recorded.',
+            '# TYPE eps_enabled gauge',
+            f'eps_enabled {int(self.enabled)}',
+            '# HELP eps_jobs_total Generation jobs processed while metrics were enabled.',
+            '# TYPE eps_jobs_total counter',
+            f'eps_jobs_total {self.jobs}',
+            '# HELP eps_stage_seconds_total Time spent in each stage of prompt expansion.',
+            '# TYPE eps_stage_seconds_total counter',
+        ]
+        lines += [f'eps_stage_seconds_total{{stage="{stage}"}} {self.stage_seconds[stage]:.9f}' for stage in STAGES]
+        lines += [
+            '# HELP eps_stage_calls_total Number of timed sections for each stage.',
+            '# TYPE eps_stage_calls_total counter',
+        ]
+        lines += [f'eps_stage_calls_total{{stage="{stage}"}} {self.stage_calls[stage]}' for stage in STAGES]
+        lines += [
+            '# HELP eps_cache_requests_total Cache lookups by cache and result.',
+            '# TYPE eps_cache_requests_total counter',
+        ]
+        lines += [
+            f'eps_cache_requests_total{{cache="{cache}",result="{result}"}} {count}'
+            for (cache, result), count in sorted(cache_requests.items())
+        ]
+        lines += [
+            '# HELP eps_combination_space_log10 log10 of the combination count of the last job, per prompt field.',
+            '# TYPE eps_combination_space_log10 gauge',
+        ]
+        lines += [
+            f'eps_combination_space_log10{{field="{escape_label(field)}"}} {value:.6f}'
+            for field, value in sorted(self.combination_space_log10.items())
+        ]
+        lines += [
+            '# HELP eps_prompt_list_size_max Largest prompt list expanded in one job.',
+            '# TYPE eps_prompt_list_size_max gauge',
+            f'eps_prompt_list_size_max {self.max_prompt_list_size}',
+            '# HELP eps_options_size_max Largest option list referenced by a template in one job.',
+            '# TYPE eps_options_size_max gauge',
+            f'eps_options_size_max {self.max_options_size}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
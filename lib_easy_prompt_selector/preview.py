@@ -0,0 +1,127 @@
+"""展開結果のプレビュー (画像を生成せずに、組み合わせ数と展開後のプロンプトを確認する)
+
+コマンドライン (cli.py) と API (scripts/api.py) で使う。組み合わせは列挙せず、ページの各インデックスから都度復元する。
+"""
+import json
+
+from lib_easy_prompt_selector.engine import (
+    combination_at,
+    count_combinations,
+    draw_random_replacements,
+    format_combination_count,
+    image_random,
+    resolve_slot,
+    resolve_templates,
+    shuffle_permutation,
+)
+from lib_easy_prompt_selector.templates import compile_prompt
+
+MODES = ('round_robin', 'shuffle', 'random')
+# 既定のフィールド名。WebUI のランダムモードではプロンプト欄の展開にこの名前を使う
+DEFAULT_SALT = 'Input Prompt'
+
+
+class Expander:
+    """1 つのプロンプトを、指定したインデックスの範囲について展開する
+
+    round_robin と shuffle の index は組み合わせ数を超えたら先頭に戻る。random の index i はシード seed + i で展開する。
+    """
+
+    def __init__(self, tags, prompt, mode, seed=None, salt=DEFAULT_SALT):
+        self.compiled = compile_prompt(prompt)
+        self.mode = mode
+        self.seed = seed
+        self.salt = salt
+        if mode in ('round_robin', 'shuffle'):
+            resolved = resolve_templates(tags, self.compiled.templates)
+            if isinstance(resolved, str):
+                raise ValueError(resolved)
+            self.resolved = resolved
+            self.total = count_combinations(tags, prompt).total
+            if mode == 'shuffle' and self.total > 0:
+                self.permutation = shuffle_permutation(self.total, prompt, tags.digest)
+        else:
+            self.slots = [resolve_slot(tags, template_info) for template_info in self.compiled.templates]
+
+    def seed_at(self, index):
+        return None if self.seed is None else self.seed + index
+
+    def prompt_at(self, index):
+        if self.mode == 'round_robin':
+            return self.compiled.substitute(combination_at(self.resolved, index % self.total))
+        if self.mode == 'shuffle':
+            return self.compiled.substitute(combination_at(self.resolved, self.permutation(index % self.total)))
+        rng = image_random(self.seed_at(index), self.salt)
+        return self.compiled.substitute(draw_random_replacements(self.slots, rng))
+
+    def record(self, index):
+        return {'index': index, 'seed': self.seed_at(index), 'prompt': self.prompt_at(index)}
+
+    def render(self, start, stop, step):
+        """範囲内の各インデックスの JSONL をまとめた bytes"""
+        lines = []
+        for index in range(start, stop, step):
+            lines.append(json.dumps(self.record(index), ensure_ascii=False))
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+
+def combination_count_data(result):
+    """CombinationCount を JSON にできる形にする"""
+    return {
+        'total': result.total,
+        'display': format_combination_count(result),
+        'error': result.error,
+        'templates': [template_count._asdict() for template_count in result.templates],
+    }
+
+
+def preview(tags, prompt, mode='round_robin', start=0, limit=20, seed=None, salt=DEFAULT_SALT, unique=False):
+    """プロンプトの組み合わせ数と、start から limit 件の展開結果
+
+    round_robin と shuffle は組み合わせ数で打ち切り (先頭には戻らない)、続きがあれば next に次の start を入れる。
+    unique の場合は、このページの中で同じ展開結果を 2 回目以降は省く (random モードの重複の確認用)。
+    """
+    result = count_combinations(tags, prompt)
+    data = {
+        'prompt': prompt,
+        'mode': mode,
+        'combinations': combination_count_data(result),
+        'start': start,
+        'next': None,
+        'results': [],
+    }
+    if mode != 'random' and result.error:
+        return data
+
+    expander = Expander(tags, prompt, mode, seed, salt)
+    stop = start + limit
+    if mode != 'random':
+        stop = min(stop, result.total)
+    if mode == 'random' or stop < result.total:
+        data['next'] = stop
+
+    seen = set()
+    for index in range(start, stop):
+        record = expander.record(index)
+        if unique:
+            if record['prompt'] in seen:
+                continue
+            seen.add(record['prompt'])
+        data['results'].append(record)
+    return data
+
+
+def preview_batch(tags, requests):
+    """複数のプレビューをまとめて行う。requests は preview の引数の dict のリスト
+
+    同じ内容のリクエストは 1 回だけ展開し、結果を共有する。
+    """
+    previews = {}
+    results = []
+    for request in requests:
+        key = tuple(sorted(request.items()))
+        if key not in previews:
+            previews[key] = preview(tags, **request)
+        results.append(previews[key])
+    return results
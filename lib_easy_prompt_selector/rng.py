@@ -0,0 +1,158 @@
+"""プロセスをまたいで再現できる、カウンタ方式の乱数生成器"""
+import hashlib
+import heapq
+import random
+import secrets
+
+_DOUBLE_SCALE = 1.0 / (1 << 53)
+
+
+def derive_key(*parts):
+    """キーの各要素 (シード, フィールド名, テンプレート位置など) から BLAKE2 の鍵を作る
+
+    hash() と違い PYTHONHASHSEED に依存しないので、再起動後や別のワーカーでも同じ鍵になる。
+    """
+    hasher = hashlib.blake2b(digest_size=32, person=b'eps-rng')
+    for part in parts:
+        data = part if isinstance(part, bytes) else repr(part).encode('utf-8')
+        hasher.update(len(data).to_bytes(8, 'little'))
+        hasher.update(data)
+    return hasher.digest()
+
+
+class StableRandom(random.Random):
+    """BLAKE2(鍵, カウンタ) を乱数列とする random.Random
+
+    n 番目の値はカウンタ n だけで決まるので、前の値を生成せずに任意の位置から始められる。
+    randint / choices / sample など random.Random のメソッドはそのまま使える。
+    """
+
+    def __init__(self, *key, counter=0):
+        self._key = derive_key(*key) if key else secrets.token_bytes(32)
+        self.counter = counter
+        super().__init__()
+
+    def seed(self, *args, **kwargs):
+        # 状態は鍵とカウンタだけなので、random.Random.__init__ からの呼び出しは無視する
+        pass
+
+    def getstate(self):
+        return self._key, self.counter
+
+    def setstate(self, state):
+        self._key, self.counter = state
+
+    def substream(self, *key):
+        """この生成器の鍵と key から導いた、独立した生成器を返す"""
+        return StableRandom(self._key, *key)
+
+    def _next64(self):
+        block = hashlib.blake2b(self.counter.to_bytes(16, 'little'), key=self._key, digest_size=8).digest()
+        self.counter += 1
+        return int.from_bytes(block, 'little')
+
+    def random(self):
+        return (self._next64() >> 11) * _DOUBLE_SCALE
+
+    def getrandbits(self, k):
+        if k < 0:
+            raise ValueError("number of bits must be non-negative")
+        value = 0
+        bits = 0
+        while bits < k:
+            value |= self._next64() << bits
+            bits += 64
+        return value >> (bits - k)
+
+
+class AliasTable:
+    """重み付きの選択を O(1) で行うための別名表 (Vose の方法)
+
+    列を n 等分し、列 i は確率 probabilities[i] で i、それ以外で aliases[i] を選ぶ。
+    """
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = sum(weights)
+        self.weights = tuple(weights)
+        scaled = [weight * count / total for weight in weights]
+        self.probabilities = [1.0] * count
+        self.aliases = list(range(count))
+
+        small = [i for i, value in enumerate(scaled) if value < 1.0]
+        large = [i for i, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # 残りは丸め誤差を除けば 1.0 なので、そのまま自分自身を選ぶ
+
+    def __len__(self):
+        return len(self.probabilities)
+
+    def draw(self, rng):
+        column = rng.randrange(len(self.probabilities))
+        return column if rng.random() < self.probabilities[column] else self.aliases[column]
+
+    def sample(self, rng, k):
+        return [self.draw(rng) for _ in range(k)]
+
+    def sample_distinct(self, rng, k):
+        """重複なしで k 個選ぶ (Efraimidis-Spirakis 法: 各列に u ** (1 / 重み) のキーを付けて上位 k 個)
+
+        重み 0 の列は、他の列が足りない場合にだけ選ばれる。
+        """
+        keys = [
+            rng.random() ** (1.0 / weight) if weight > 0 else -1.0
+            for weight in self.weights
+        ]
+        return heapq.nlargest(k, range(len(keys)), key=keys.__getitem__)
+
+
+class FeistelPermutation:
+    """[0, size) の並べ替え (鍵付きの Feistel ネットワークと cycle walking による全単射)
+
+    size 以上の最小の 2^(2h) の範囲で Feistel ネットワークを適用し、size 以上になった値にはもう一度適用する。
+    その範囲は size の 4 倍未満なので、適用回数は平均 4 回未満。表を作らないので size がどれだけ大きくてもメモリは一定。
+    """
+    ROUNDS = 4
+
+    def __init__(self, size, *key):
+        if size <= 0:
+            raise ValueError("permutation size must be positive")
+        self.size = size
+        self.half_bits = (max((size - 1).bit_length(), 2) + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.half_bytes = (self.half_bits + 7) // 8
+        self._key = derive_key('feistel', *key)
+
+    def _round(self, round_index, value):
+        data = bytes((round_index,)) + value.to_bytes(self.half_bytes, 'little')
+        output = b''
+        block = 0
+        while len(output) < self.half_bytes:
+            output += hashlib.blake2b(data + block.to_bytes(4, 'little'), key=self._key).digest()
+            block += 1
+        return int.from_bytes(output[:self.half_bytes], 'little') & self.mask
+
+    def _encrypt(self, value):
+        left, right = value >> self.half_bits, value & self.mask
+        for round_index in range(self.ROUNDS):
+            left, right = right, left ^ self._round(round_index, right)
+        return (left << self.half_bits) | right
+
+    def __len__(self):
+        return self.size
+
+    def __call__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError("permutation index out of range")
+        if self.size == 1:
+            return 0
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
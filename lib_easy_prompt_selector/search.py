@@ -0,0 +1,433 @@
+"""タグの検索索引 (キー・値・パスの前方一致と、トライグラムによる部分一致、編集距離によるあいまい検索)
+
+索引はファイルごとに作り (FileSearchIndex)、タグを読み直したときは変更されたファイルの分だけ作り直す。
+前方一致には単語の並べ替え済みリストを二分探索で使う (トライ木と同じ検索ができ、メモリが少ない)。
+部分一致は、1 単語のクエリなら単語の一覧 (語彙) から単語の途中に含む単語を探し、
+複数の単語のクエリなら日本語でも単語に区切らずに使える文字トライグラムの転置索引で候補を絞って確かめる。
+一致の種類とフィールドの重みごとに点数が決まっているので、点数の高い段から順に entry の集合を求め、
+件数は集合演算で数え、ページに必要な上位だけを取り出す (一致した全件を並べ替えない)。
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from itertools import compress, filterfalse, groupby, islice, repeat
+from operator import contains
+import heapq
+import re
+import threading
+import unicodedata
+
+from lib_easy_prompt_selector.tags import NODE_LIST, NODE_MAPPING, NODE_VALUE
+from lib_easy_prompt_selector.templates import parse_weighted_option
+
+# 検索結果の種類。tag はボタン 1 つ (キーと値)、path はファイルやカテゴリ
+KIND_TAG = 'tag'
+KIND_PATH = 'path'
+
+# フィールドごとの重み (ボタンの表示名 > 挿入される値 > カテゴリ名)
+KEY_WEIGHT = 1.0
+VALUE_WEIGHT = 0.9
+PATH_WEIGHT = 0.8
+WEIGHTS = (KEY_WEIGHT, VALUE_WEIGHT, PATH_WEIGHT)
+
+# 一致の種類ごとの点数 (あいまい一致はどの重みでも部分一致より下になる)
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.9
+WORD_PREFIX_SCORE = 0.8
+SUBSTRING_SCORE = 0.7
+FUZZY_SCORE = 0.5
+# 点数の高い順の (点数, 一致の種類, フィールドの番号)。同点を比べられるように丸めておく
+MATCH_EXACT = 'exact'
+MATCH_PREFIX = 'prefix'
+MATCH_WORD_PREFIX = 'word_prefix'
+MATCH_SUBSTRING = 'substring'
+MATCH_LEVELS = sorted(
+    ((round(score * weight, 6), kind, weight_index)
+     for kind, score in ((MATCH_EXACT, EXACT_SCORE), (MATCH_PREFIX, PREFIX_SCORE), (MATCH_WORD_PREFIX, WORD_PREFIX_SCORE), (MATCH_SUBSTRING, SUBSTRING_SCORE))
+     for weight_index, weight in enumerate(WEIGHTS)),
+    key=lambda level: -level[0])
+# 前方一致・部分一致がこの件数未満のときだけ、あいまい一致を探す
+FUZZY_FALLBACK_SIZE = 100
+# あいまい一致で許す編集距離 (置換・挿入・削除・隣り合う文字の入れ替え) と、それを許す単語の長さ
+FUZZY_EDITS = ((3, 1), (7, 2))
+
+# トライグラムを作るときの前後の埋め草。どの文字からも 3 文字のトライグラムが始まるように後ろは 2 文字
+PAD_START = '\x02'
+PAD_END = '\x03\x03'
+# 前方一致の範囲の終わりを二分探索するための、どの文字よりも大きい文字
+PREFIX_END = '\U0010ffff'
+# 結果のキャッシュ。各クエリの上位 (ページに必要な分) だけを、合計 RESULT_CACHE_ENTRIES 件まで保持する
+RESULT_CACHE_SIZE = 64
+RESULT_CACHE_ENTRIES = 20000
+RESULT_WINDOW = 100
+
+WORD_SEPARATOR = re.compile(r'[\s,_/>:()\[\]{}|.\-]+')
+
+
+def normalize(text):
+    """全角・半角や大文字・小文字の違いを無視するための正規化"""
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def split_words(text):
+    return [word for word in WORD_SEPARATOR.split(text) if word]
+
+
+def padded_trigrams(word):
+    padded = PAD_START + word + PAD_END
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def query_trigrams(query):
+    """部分一致の候補を探すためのクエリのトライグラム
+
+    区切り文字の前の単語は本文の単語の末尾に、区切り文字の後の単語は本文の単語の先頭にあるはずなので、埋め草を付ける。
+    """
+    parts = WORD_SEPARATOR.split(query)
+    grams = []
+    for i, part in enumerate(parts):
+        if part:
+            padded = (PAD_START if i > 0 else '') + part + (PAD_END if i < len(parts) - 1 else '')
+            grams.extend(padded[j:j + 3] for j in range(len(padded) - 2))
+    return grams
+
+
+def allowed_edits(word):
+    edits = 0
+    for length, count in FUZZY_EDITS:
+        if len(word) >= length:
+            edits = count
+    return edits
+
+
+def edit_distance(a, b, limit):
+    """隣り合う文字の入れ替えも 1 回と数える編集距離。limit を超える場合は limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class _PrefixList:
+    """並べ替えた文字列と、同じ順の entry の番号"""
+    __slots__ = ('keys', 'entries')
+
+    def __init__(self, rows):
+        rows = sorted(rows)
+        self.keys = [key for key, _ in rows]
+        self.entries = array('I', (entry_id for _, entry_id in rows))
+
+    def prefix_range(self, query):
+        start = bisect_left(self.keys, query)
+        return start, bisect_left(self.keys, query + PREFIX_END, start)
+
+    def equal(self, key):
+        start = bisect_left(self.keys, key)
+        return self.entries[start:bisect_right(self.keys, key, start)]
+
+
+class FileSearchIndex:
+    """1 つのタグファイルの検索索引
+
+    entries は (種類, パス, キー, 値) で、キーの短い順に並べる (entry の番号の順がそのまま同点の場合の順位になる)。
+    値は重み (N::) を除いたもの (ボタンに表示・挿入されるのと同じ) で索引し、返す。
+    パスにはファイル名を含み、キーは FileIndex と同じ (intern された) 文字列を共有する。
+    フィールド (キー・値・パス) の重みごとに、正規化した文字列 (texts)、文字列全体と単語の前方一致用のリスト、
+    トライグラム -> entry の番号の転置索引を持つ。vocabulary は部分一致とあいまい一致に使う単語の一覧。
+    initials は単語の頭文字ごとの entry の数で、1 文字のクエリの件数を一致する entry を集めずに求めるために使う。
+    """
+    __slots__ = ('file_index', 'entries', 'key_lengths', 'texts', 'wholes', 'words', 'grams', 'vocabulary', 'vocabulary_grams', 'vocabulary_gram_keys', 'initials')
+
+    def __init__(self, name, file_index):
+        self.file_index = file_index
+        entries = []
+        for path, node in sorted(file_index.walk((name,)), key=lambda item: (item[1].start, len(item[0]))):
+            if node.kind == NODE_MAPPING or node.kind == NODE_LIST:
+                entries.append(((KIND_PATH, path, path[-1], None), (None, None, path[-1])))
+            if node.kind == NODE_LIST:
+                for _, value in map(parse_weighted_option, file_index.leaves[node.start:node.stop]):
+                    entries.append(((KIND_TAG, path, value, value), (value, None, None)))
+            elif node.kind == NODE_VALUE:
+                _, value = parse_weighted_option(file_index.leaves[node.start])
+                entries.append(((KIND_TAG, path[:-1], path[-1], value), (path[-1], value, None)))
+        entries.sort(key=lambda entry: len(entry[0][2]))
+        self.entries = [entry for entry, _ in entries]
+        self.key_lengths = array('I', (len(key) for _, _, key, _ in self.entries))
+
+        self.texts = tuple([None] * len(entries) for _ in WEIGHTS)
+        self.initials = Counter()
+        vocabulary = set()
+        wholes = tuple([] for _ in WEIGHTS)
+        words = tuple([] for _ in WEIGHTS)
+        postings = tuple({} for _ in WEIGHTS)
+        for entry_id, (_, fields) in enumerate(entries):
+            seen = set()
+            initials = set()
+            for weight_index, text in enumerate(fields):
+                if not text: # 値のない entry や、重みだけの値
+                    continue
+                text = normalize(text)
+                if text in seen:
+                    continue # 値がキーと同じなら、重みの大きいキーとしてだけ数える
+                seen.add(text)
+                self.texts[weight_index][entry_id] = text
+                wholes[weight_index].append((text, entry_id))
+                text_words = split_words(text)
+                vocabulary.update(text_words)
+                initials.add(text[0])
+                initials.update(word[0] for word in text_words)
+                words[weight_index].extend((word, entry_id) for word in set(text_words) if word != text)
+                grams = set()
+                for word in text_words:
+                    grams.update(padded_trigrams(word))
+                for gram in grams:
+                    postings[weight_index].setdefault(gram, []).append(entry_id)
+            self.initials.update(initials)
+        self.wholes = tuple(_PrefixList(rows) for rows in wholes)
+        self.words = tuple(_PrefixList(rows) for rows in words)
+        self.grams = tuple({gram: array('I', entry_ids) for gram, entry_ids in grams.items()} for grams in postings)
+
+        self.vocabulary = sorted(vocabulary)
+        vocabulary_grams = {}
+        for word_id, word in enumerate(self.vocabulary):
+            for gram in padded_trigrams(word):
+                vocabulary_grams.setdefault(gram, []).append(word_id)
+        self.vocabulary_grams = {gram: array('I', word_ids) for gram, word_ids in vocabulary_grams.items()}
+        self.vocabulary_gram_keys = sorted(self.vocabulary_grams)
+
+    def count(self, query, query_grams):
+        """前方一致・部分一致する entry の数"""
+        if len(query) == 1:
+            return self.initials.get(query, 0)
+        return len(self.hits(query, query_grams))
+
+    def hits(self, query, query_grams):
+        """前方一致・部分一致するすべての entry の番号の集合 (件数を数えるため。点数は level で段ごとに求める)"""
+        hits = set()
+        for weight_index in range(len(WEIGHTS)):
+            for prefixes in (self.wholes[weight_index], self.words[weight_index]):
+                start, stop = prefixes.prefix_range(query)
+                if start < stop:
+                    hits.update(prefixes.entries[start:stop])
+            if len(query) >= 2:
+                hits.update(self.substring_matches(weight_index, query, query_grams, hits))
+        return hits
+
+    def level(self, query, query_grams, kind, weight_index, seen):
+        """MATCH_LEVELS の 1 段に一致する entry のうち、seen (より高い点数で一致したもの) に含まれない entry の番号の集合"""
+        if kind == MATCH_SUBSTRING:
+            return self.substring_matches(weight_index, query, query_grams, seen) if len(query) >= 2 else set()
+        prefixes = self.words[weight_index] if kind == MATCH_WORD_PREFIX else self.wholes[weight_index]
+        start, stop = prefixes.prefix_range(query)
+        if start < stop and kind != MATCH_WORD_PREFIX:
+            equal = bisect_right(prefixes.keys, query, start, stop)
+            start, stop = (start, equal) if kind == MATCH_EXACT else (equal, stop)
+        entry_ids = set(prefixes.entries[start:stop])
+        entry_ids.difference_update(seen)
+        return entry_ids
+
+    def substring_matches(self, weight_index, query, query_grams, seen):
+        """部分一致する entry のうち seen に含まれないもの"""
+        if WORD_SEPARATOR.search(query) is None:
+            # 1 単語のクエリは単語の中で一致するので、単語の先頭以外に含む語彙を持つ entry だけを調べればよい
+            # (単語の先頭での一致は前方一致で数えている)
+            entry_ids = set()
+            for word in self.inner_words(query):
+                entry_ids.update(self.wholes[weight_index].equal(word))
+                entry_ids.update(self.words[weight_index].equal(word))
+            entry_ids.difference_update(seen)
+            return entry_ids
+
+        # 複数の単語のクエリは、最も短いトライグラムの転置リストの entry を候補にして、クエリを含むか確かめる
+        texts = self.texts[weight_index]
+        grams = self.grams[weight_index]
+        candidates = None
+        for gram in query_grams:
+            entry_ids = grams.get(gram)
+            if entry_ids is None:
+                return set()
+            if candidates is None or len(entry_ids) < len(candidates):
+                candidates = entry_ids
+        if candidates is None:
+            # トライグラムにならないのは区切り文字の後が 1 文字だけのクエリ ("(m" など) なので、その文字で始まる単語を持つ entry を調べる
+            # (区切り文字だけのクエリは、このフィールドを持つすべての entry を調べる)
+            last = WORD_SEPARATOR.split(query)[-1]
+            if last:
+                candidates = set()
+                for prefixes in (self.wholes[weight_index], self.words[weight_index]):
+                    start, stop = prefixes.prefix_range(last)
+                    candidates.update(prefixes.entries[start:stop])
+            else:
+                candidates = compress(range(len(texts)), texts)
+        candidates = list(filterfalse(seen.__contains__, candidates))
+        return set(compress(candidates, map(contains, map(texts.__getitem__, candidates), repeat(query))))
+
+    def inner_words(self, query):
+        """クエリを 2 文字目以降に含む語彙"""
+        if len(query) < 3:
+            # クエリで始まるトライグラムを持つ単語
+            word_ids = set()
+            position = bisect_left(self.vocabulary_gram_keys, query)
+            while position < len(self.vocabulary_gram_keys) and self.vocabulary_gram_keys[position].startswith(query):
+                word_ids.update(self.vocabulary_grams[self.vocabulary_gram_keys[position]])
+                position += 1
+        else:
+            word_ids = None
+            for i in range(len(query) - 2):
+                candidates = self.vocabulary_grams.get(query[i:i + 3])
+                if candidates is None:
+                    return []
+                if word_ids is None or len(candidates) < len(word_ids):
+                    word_ids = candidates
+        return [word for word in map(self.vocabulary.__getitem__, word_ids) if query in word[1:]]
+
+    def similar_words(self, word):
+        """編集距離が許容範囲内の語彙"""
+        edits = allowed_edits(word)
+        if edits == 0:
+            index = bisect_left(self.vocabulary, word)
+            return [word] if index < len(self.vocabulary) and self.vocabulary[index] == word else []
+        # 1 回の編集では、先頭と末尾のトライグラムの両方は壊れないので、どれかを共有する単語だけを調べる
+        word_ids = set()
+        for gram in padded_trigrams(word):
+            word_ids.update(self.vocabulary_grams.get(gram, ()))
+        return [self.vocabulary[word_id] for word_id in word_ids if edit_distance(word, self.vocabulary[word_id], edits) <= edits]
+
+    def fuzzy_match(self, query):
+        """あいまい一致の (点数, entry の番号の集合) のリスト。クエリのすべての単語が、同じフィールドの単語に似ていれば一致"""
+        similar = [self.similar_words(word) for word in split_words(query)]
+        if not similar or not all(similar):
+            return []
+        levels = []
+        for weight_index, weight in enumerate(WEIGHTS):
+            matched = None
+            for words in similar:
+                entry_ids = set()
+                for word in words:
+                    entry_ids.update(self.wholes[weight_index].equal(word))
+                    entry_ids.update(self.words[weight_index].equal(word))
+                matched = entry_ids if matched is None else matched & entry_ids
+                if not matched:
+                    break
+            if matched:
+                levels.append((round(FUZZY_SCORE * weight, 6), matched))
+        return levels
+
+    def entry_data(self, entry_id):
+        kind, path, key, value = self.entries[entry_id]
+        return {'kind': kind, 'file': path[0], 'path': list(path[1:]), 'key': key, 'value': value}
+
+
+class SearchIndex:
+    """TagLibrary 全体の検索索引
+
+    previous を渡すと、FileIndex が同じ (変更されていない) ファイルの索引はそのまま再利用する。
+    """
+
+    def __init__(self, library, previous=None):
+        self.library_version = library.version
+        self.files = {}
+        for name in library:
+            file_index = library.file_index(name)
+            shard = previous.files.get(name) if previous is not None else None
+            if shard is None or shard.file_index is not file_index:
+                shard = FileSearchIndex(name, file_index)
+            self.files[name] = shard
+        self._results = {}
+        self._cached_entries = 0
+        self._lock = threading.Lock()
+
+    def rank(self, query, window, files=None):
+        """(一致した件数, 上位 window 件の (点数, ファイル名, entry の番号) のリスト)
+
+        前方一致・部分一致が FUZZY_FALLBACK_SIZE 件未満のときだけ、あいまい一致も加える。
+        """
+        cache_key = (query, files)
+        with self._lock:
+            cached = self._results.get(cache_key)
+        if cached is not None and (len(cached[1]) >= window or len(cached[1]) == cached[0]):
+            return cached
+
+        shards = [(name, shard) for name, shard in self.files.items() if files is None or name in files]
+        query_grams = query_trigrams(query)
+        counts = {name: shard.count(query, query_grams) for name, shard in shards}
+        total = sum(counts.values())
+        fuzzy = []
+        if total < FUZZY_FALLBACK_SIZE and len(query) >= 3:
+            for name, shard in shards:
+                matched = shard.hits(query, query_grams)
+                for score, entry_ids in shard.fuzzy_match(query):
+                    entry_ids.difference_update(matched)
+                    if entry_ids:
+                        matched.update(entry_ids)
+                        fuzzy.append((score, name, entry_ids))
+                        total += len(entry_ids)
+
+        # 点数の高い段から順に、ページに必要な件数が揃うまでだけ各段の entry を求める。
+        # 同点の中ではキーの短い順 (entry の番号の順)、ファイル名の順
+        top = []
+        seen = {name: set() for name in counts}
+        for score, group in groupby(MATCH_LEVELS, key=lambda level: level[0]):
+            group = list(group)
+            ranked = []
+            for name, shard in shards:
+                if len(seen[name]) == counts[name]:
+                    continue
+                entry_ids = set()
+                for _, kind, weight_index in group:
+                    entry_ids.update(shard.level(query, query_grams, kind, weight_index, seen[name]))
+                if entry_ids:
+                    seen[name].update(entry_ids)
+                    ranked.append(self.ranked_entries(name, entry_ids))
+            self.take(top, window, score, ranked)
+            if len(top) >= window:
+                break
+        fuzzy.sort(key=lambda level: -level[0])
+        for score, group in groupby(fuzzy, key=lambda level: level[0]):
+            if len(top) >= window:
+                break
+            self.take(top, window, score, [self.ranked_entries(name, entry_ids) for _, name, entry_ids in group])
+
+        result = (total, top)
+        with self._lock:
+            previous = self._results.pop(cache_key, None)
+            if previous is not None:
+                self._cached_entries -= len(previous[1])
+            while self._results and (len(self._results) >= RESULT_CACHE_SIZE or self._cached_entries + len(top) > RESULT_CACHE_ENTRIES):
+                self._cached_entries -= len(self._results.pop(next(iter(self._results)))[1])
+            if len(top) <= RESULT_CACHE_ENTRIES:
+                self._results[cache_key] = result
+                self._cached_entries += len(top)
+        return result
+
+    @staticmethod
+    def take(top, window, score, ranked):
+        top.extend((score, name, entry_id) for _, name, entry_id in islice(heapq.merge(*ranked), window - len(top)))
+
+    def ranked_entries(self, name, entry_ids):
+        key_lengths = self.files[name].key_lengths
+        return ((key_lengths[entry_id], name, entry_id) for entry_id in sorted(entry_ids))
+
+    def search(self, query, offset=0, limit=50, files=None):
+        """検索結果の 1 ページ分。files を指定するとそのファイルだけを検索する"""
+        query = normalize(query).strip()
+        if not query:
+            return {'query': query, 'total': 0, 'offset': offset, 'results': []}
+        total, top = self.rank(query, max(offset + limit, RESULT_WINDOW), frozenset(files) if files else None)
+        results = []
+        for score, name, entry_id in top[offset:offset + limit]:
+            result = self.files[name].entry_data(entry_id)
+            result['score'] = score
+            results.append(result)
+        return {'query': query, 'total': total, 'offset': offset, 'results': results}
@@ -0,0 +1,66 @@
+"""拡張機能全体で共有するタグの読み込み状態 (UI スクリプトと API で同じものを使う)"""
+from pathlib import Path
+import importlib.util
+import threading
+import time
+
+from lib_easy_prompt_selector.cursors import CursorStore
+from lib_easy_prompt_selector.metrics import metrics
+from lib_easy_prompt_selector.tags import TagLoader
+from lib_easy_prompt_selector.watcher import TagWatcher
+
+EXTENSION_DIR = Path(__file__).resolve().parent.parent
+TAGS_DIR = EXTENSION_DIR.joinpath('tags')
+CACHE_FILE = EXTENSION_DIR.joinpath('.cache', 'tags.pickle')
+CURSOR_FILE = EXTENSION_DIR.joinpath('.cache', 'cursors.sqlite3')
+
+tag_loader = TagLoader(TAGS_DIR, cache_file=CACHE_FILE)
+# ラウンドロビンの進捗。同じ拡張機能ディレクトリを使うワーカー間で共有される
+cursor_store = CursorStore(CURSOR_FILE)
+
+# 公開中のタグのスナップショット。読み込みが終わったライブラリだけを代入で差し替える
+# (TagLibrary は作った後に変更しないので、参照を取得したスレッドはロックなしで使える)
+current_library = None
+_load_lock = threading.Lock()
+
+
+def write_filename_list():
+    """scripts/setup.py の write_filename_list を呼び出す"""
+    setup_path = EXTENSION_DIR.joinpath('scripts', 'setup.py')
+    spec = importlib.util.spec_from_file_location('eps_setup', setup_path)
+    if spec and spec.loader:
+        setup_mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(setup_mod)
+        if hasattr(setup_mod, 'write_filename_list') and callable(setup_mod.write_filename_list):
+            setup_mod.write_filename_list()
+
+
+def load_tags():
+    """変更されたタグファイルだけを読み直し、現在のライブラリとして公開して返す
+
+    タグファイルの追加・削除があった場合は、ファイル一覧 (tmp/easyPromptSelector.txt) も書き直す。
+    読み込みは同時に 1 つだけ行う。
+    """
+    global current_library
+    with _load_lock:
+        started = time.perf_counter()
+        library = tag_loader.load()
+        if metrics.enabled:
+            metrics.observe('load', time.perf_counter() - started)
+        if tag_loader.filenames_changed:
+            try:
+                write_filename_list()
+            except Exception as e:
+                print(f"EasyPromptSelector: failed to execute write_filename_list: {e}")
+        current_library = library
+    return library
+
+
+def current_tags():
+    """公開中のタグのスナップショットを返す。まだ読み込んでいなければ読み込む"""
+    library = current_library
+    return library if library is not None else load_tags()
+
+
+# 設定で有効にした場合に、タグファイルの変更をバックグラウンドで読み直す
+tag_watcher = TagWatcher(TAGS_DIR, load_tags)
@@ -0,0 +1,431 @@
+"""タグファイルの読み込みと、選択肢の索引"""
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Mapping
+from typing import NamedTuple
+import hashlib
+import itertools
+import os
+import pickle
+import sys
+
+import yaml
+
+from lib_easy_prompt_selector.templates import TEMPLATE_PATTERN, parse_template
+
+# libyaml が使える環境では C 実装のローダーを使う (結果は SafeLoader と同じ)
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# パース済みタグのディスクキャッシュの形式。中身の構造を変えたら上げる
+CACHE_VERSION = 2
+
+
+def parse_yaml(text, loader=YAML_LOADER):
+    return yaml.load(text, Loader=loader)
+
+
+class TagFile(NamedTuple):
+    mtime_ns: int
+    size: int
+    digest: str
+    data: object  # FileIndex (パースした YAML そのものは保持しない)
+
+
+class TagLoader:
+    """タグファイルごとに mtime・サイズ・ハッシュを記録し、変更されたファイルだけを読み直す"""
+
+    def __init__(self, tags_dir, cache_file=None, yaml_loader=YAML_LOADER):
+        self.tags_dir = tags_dir
+        self.cache_file = cache_file
+        self.yaml_loader = yaml_loader
+        self.files = {}    # Path -> TagFile
+        self.sources = {}  # ファイル名 -> 採用された Path (同名ファイルは後に見つかった方)
+        self.library = None
+        self.filenames_changed = False
+
+    def load(self):
+        files = {}
+        changed_names = set()
+        cached = self.read_cache() if self.library is None else {}
+        parsed = False
+        for filepath in self.tags_dir.rglob("*.yml"):
+            stat = filepath.stat()
+            record = self.files.get(filepath)
+            if record is None or record.mtime_ns != stat.st_mtime_ns or record.size != stat.st_size:
+                content = filepath.read_bytes()
+                digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+                if record is None or record.digest != digest:
+                    if digest in cached:
+                        data = cached[digest]
+                    else:
+                        data = FileIndex.build(parse_yaml(content.decode("utf-8"), self.yaml_loader))
+                        parsed = True
+                    record = TagFile(stat.st_mtime_ns, stat.st_size, digest, data)
+                    changed_names.add(filepath.stem)
+                else:
+                    # touch されただけで内容は同じ
+                    record = record._replace(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            files[filepath] = record
+
+        sources = {filepath.stem: filepath for filepath in files}
+        changed_names.update(name for name in self.sources.keys() | sources.keys() if self.sources.get(name) != sources.get(name))
+
+        # 起動時にすべてキャッシュから読めた場合は書き直さない
+        if parsed or (self.library is not None and files.keys() != self.files.keys()):
+            self.write_cache(files.values())
+
+        self.filenames_changed = self.library is None or files.keys() != self.files.keys()
+        self.files = files
+        self.sources = sources
+
+        if self.library is None or changed_names:
+            tags = {name: files[filepath].data for name, filepath in sources.items()}
+            digest = library_digest({name: files[filepath].digest for name, filepath in sources.items()})
+            self.library = TagLibrary(tags, self.library, changed_names, digest)
+            for cycle in self.library.cycles:
+                print(f"[EasyPromptSelector] Circular tag reference: {describe_cycle(cycle)}")
+        return self.library
+
+    def cache_key(self):
+        return (CACHE_VERSION, yaml.__version__)
+
+    def read_cache(self):
+        """ファイル内容のハッシュ -> パース済みデータ。キャッシュが無い・古い・壊れている場合は空"""
+        if self.cache_file is None:
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as file:
+                key, entries = pickle.load(file)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"[EasyPromptSelector] Ignoring unreadable tag cache {self.cache_file}: {e}")
+            return {}
+        return entries if key == self.cache_key() else {}
+
+    def write_cache(self, records):
+        if self.cache_file is None:
+            return
+        entries = {record.digest: record.data for record in records}
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            temp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(temp_file, 'wb') as file:
+                pickle.dump((self.cache_key(), entries), file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, self.cache_file)
+        except Exception as e:
+            print(f"[EasyPromptSelector] Failed to write tag cache {self.cache_file}: {e}")
+
+
+# FileIndex のノードの種類 (元の YAML の形を復元するために使う)
+NODE_MAPPING, NODE_LIST, NODE_VALUE, NODE_EMPTY = range(4)
+
+
+def intern_option(value):
+    return sys.intern(value if isinstance(value, str) else str(value))
+
+
+class IndexNode:
+    """タグファイル内の 1 つのパス。選択肢は FileIndex.leaves[start:stop]、子は NODE_MAPPING の場合だけ"""
+    __slots__ = ('kind', 'start', 'stop', 'children')
+
+    def __init__(self, kind, start, stop, children=None):
+        self.kind = kind
+        self.start = start
+        self.stop = stop
+        self.children = children
+
+
+class FileIndex:
+    """1 つのタグファイルのコンパクトな表現
+
+    全選択肢を深さ優先順に並べたタプル (leaves) と、各パスの選択肢が leaves のどの範囲かを表すノードの木からなる。
+    あるパスの選択肢は子孫の選択肢を順に連結したものなので、必ず連続した範囲になり、パスごとにコピーを持たずに済む。
+    文字列は sys.intern するので、複数のファイルに同じ値があってもメモリ上は 1 つになる。
+    """
+    __slots__ = ('leaves', 'root')
+
+    def __init__(self, leaves, root):
+        self.leaves = leaves
+        self.root = root
+
+    @classmethod
+    def build(cls, data):
+        leaves = []
+
+        def visit(data):
+            start = len(leaves)
+            if isinstance(data, dict):
+                children = {sys.intern(str(key)): visit(value) for key, value in data.items()}
+                return IndexNode(NODE_MAPPING, start, len(leaves), children)
+            if isinstance(data, list):
+                # リストの要素はそのまま選択肢になる (要素の中までは展開しない)
+                leaves.extend(intern_option(value) for value in data if value is not None)
+                return IndexNode(NODE_LIST, start, len(leaves))
+            if data is None:
+                return IndexNode(NODE_EMPTY, start, start)
+            leaves.append(intern_option(data))
+            return IndexNode(NODE_VALUE, start, start + 1)
+
+        root = visit(data)
+        return cls(tuple(leaves), root)
+
+    def __getstate__(self):
+        return self.leaves, self.root
+
+    def __setstate__(self, state):
+        # ディスクキャッシュから読んだ文字列も、新しくパースしたファイルの文字列と共有させる
+        leaves, self.root = state
+        self.leaves = tuple(map(sys.intern, leaves))
+
+    def node(self, keys):
+        node = self.root
+        for key in keys:
+            if node.children is None:
+                return None
+            node = node.children.get(key)
+            if node is None:
+                return None
+        return node
+
+    def options(self, keys):
+        node = self.node(keys)
+        return self.leaves[node.start:node.stop] if node is not None else None
+
+    def walk(self, path=()):
+        """(パス, ノード) を深さ優先で列挙する"""
+        pending = [(path, self.root)]
+        while pending:
+            path, node = pending.pop()
+            yield path, node
+            if node.children:
+                pending.extend((path + (key,), child) for key, child in node.children.items())
+
+    def to_data(self, node=None):
+        """YAML を読み込んだときと同じ形のデータに戻す (値は文字列になる)"""
+        node = self.root if node is None else node
+        if node.kind == NODE_MAPPING:
+            return {key: self.to_data(child) for key, child in node.children.items()}
+        if node.kind == NODE_LIST:
+            return list(self.leaves[node.start:node.stop])
+        if node.kind == NODE_VALUE:
+            return self.leaves[node.start]
+        return None
+
+    def structure_size(self):
+        """文字列を除いた、索引自体のバイト数"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.leaves)
+        for _, node in self.walk():
+            size += sys.getsizeof(node)
+            if node.children is not None:
+                size += sys.getsizeof(node.children)
+        return size
+
+    def strings(self):
+        """このファイルが参照している文字列 (選択肢とキー)"""
+        strings = {id(option): option for option in self.leaves}
+        for _, node in self.walk():
+            if node.children:
+                strings.update((id(key), key) for key in node.children)
+        return strings
+
+
+def collect_dependencies(name, file_index):
+    """選択肢に @...@ を含むパス -> そのテンプレートが参照するパスの集合"""
+    refs_at = {}
+    for position, option in enumerate(file_index.leaves):
+        if '@' in option:
+            refs = {parse_template(match).ref for match in TEMPLATE_PATTERN.finditer(option)}
+            if refs:
+                refs_at[position] = refs
+    if not refs_at:
+        return {}
+
+    # 各パスの選択肢は leaves の連続した範囲なので、テンプレートを含む位置を二分探索する
+    positions = sorted(refs_at)
+    dependencies = {}
+    for path, node in file_index.walk((name,)):
+        first = bisect_left(positions, node.start)
+        last = bisect_left(positions, node.stop)
+        if first < last:
+            dependencies[path] = frozenset().union(*(refs_at[position] for position in positions[first:last]))
+    return dependencies
+
+
+def find_cycles(dependencies):
+    """参照の循環 (強連結成分) の一覧と、循環に含まれるパスの集合を返す"""
+    # Tarjan のアルゴリズム (再帰の深さ制限を避けるため明示的なスタックで実装)
+    order = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+    for root in dependencies:
+        if root in order:
+            continue
+        work = [(root, iter(dependencies[root]))]
+        order[root] = lowlink[root] = len(order)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, edges = work[-1]
+            for ref in edges:
+                if ref not in dependencies:
+                    continue
+                if ref not in order:
+                    order[ref] = lowlink[ref] = len(order)
+                    stack.append(ref)
+                    on_stack.add(ref)
+                    work.append((ref, iter(dependencies[ref])))
+                    break
+                if ref in on_stack:
+                    lowlink[node] = min(lowlink[node], order[ref])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == order[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in dependencies[node]:
+                        cycles.append(tuple(reversed(component)))
+
+    cyclic = frozenset(path for cycle in cycles for path in cycle)
+    return cycles, cyclic
+
+
+def describe_cycle(cycle):
+    return ' -> '.join(':'.join(path) for path in cycle + cycle[:1])
+
+
+def library_digest(file_digests):
+    """ファイル名 -> ファイルのハッシュ から、ライブラリ全体の内容のハッシュを作る (プロセスをまたいで同じ値になる)"""
+    hasher = hashlib.blake2b(digest_size=16)
+    for name in sorted(file_digests):
+        hasher.update(f"{name}\0{file_digests[name]}\n".encode('utf-8'))
+    return hasher.hexdigest()
+
+
+_library_versions = itertools.count(1)
+
+
+class TagLibrary(Mapping):
+    """読み込んだタグファイル (ファイル名 -> FileIndex) と、選択肢の参照関係
+
+    tags の値は FileIndex か、YAML を読み込んだままのデータ (その場合はここで FileIndex にする)。
+    ライブラリとしては ファイル名 -> YAML と同じ形のデータ の Mapping として振る舞う。
+    previous を渡すと changed_names 以外のファイルの参照関係はそのまま再利用する。
+    解決済みの選択肢 (derived['nodes']) も、参照をたどって変更されたファイルに届かないものは引き継ぐ。
+    選択肢に含まれるテンプレートの参照関係 (dependencies) も読み込み時に求め、循環があれば cycles に記録する。
+    version はプロセス内の通し番号、digest は内容のハッシュ (再起動後や別のワーカーでも同じ)。
+    """
+
+    def __init__(self, tags, previous=None, changed_names=(), digest=None):
+        self._files = {
+            str(name): data if isinstance(data, FileIndex) else FileIndex.build(data)
+            for name, data in tags.items()
+        }
+        self.version = next(_library_versions)
+        if digest is None:
+            digest = library_digest({name: hashlib.blake2b(repr(self[name]).encode('utf-8'), digest_size=16).hexdigest() for name in self._files})
+        self.digest = digest
+        self.derived = {}  # 組み合わせ数など、このライブラリから計算した値のキャッシュ
+        self._dependencies = {}
+        for name, file_index in self._files.items():
+            if previous is not None and name not in changed_names and name in previous._dependencies:
+                self._dependencies[name] = previous._dependencies[name]
+            else:
+                self._dependencies[name] = collect_dependencies(name, file_index)
+
+        self.dependencies = {path: refs for dependencies in self._dependencies.values() for path, refs in dependencies.items()}
+        self.cycles, self.cyclic = find_cycles(self.dependencies)
+        if previous is not None:
+            nodes = self._unchanged_nodes(previous, changed_names)
+            if nodes:
+                self.derived['nodes'] = nodes
+
+    def _unchanged_nodes(self, previous, changed_names):
+        """previous の解決済みの選択肢のうち、変更されたファイルのパスを (ネストした参照をたどっても) 含まないもの"""
+        # 別のスレッドが解決中でも、dict のコピーは途中の状態を見ない
+        nodes = dict(previous.derived.get('nodes', {}))
+        if not nodes:
+            return nodes
+        changed = set(changed_names) | (previous._files.keys() ^ self._files.keys())
+
+        # 変更されたファイルのパスから、それを参照するパスへ逆向きにたどる
+        dependents = {}
+        for path, refs in self.dependencies.items():
+            for ref in refs:
+                dependents.setdefault(ref, []).append(path)
+        stale = set()
+        pending = [ref for ref in nodes.keys() | dependents.keys() if ref and ref[0] in changed]
+        while pending:
+            ref = pending.pop()
+            if ref not in stale:
+                stale.add(ref)
+                pending.extend(dependents.get(ref, ()))
+        return {ref: node for ref, node in nodes.items() if ref not in stale}
+
+    def file_index(self, name):
+        return self._files[name]
+
+    def lookup(self, path):
+        file_index = self._files.get(path[0]) if path else None
+        return file_index.options(path[1:]) if file_index is not None else None
+
+    def memory_report(self):
+        """ファイルごとのメモリ使用量の見積もり (バイト)
+
+        複数のファイルで共有している文字列は、使っているファイルの数で按分する。
+        """
+        strings = {name: file_index.strings() for name, file_index in self._files.items()}
+        owners = Counter(string_id for file_strings in strings.values() for string_id in file_strings)
+        report = []
+        for name, file_index in self._files.items():
+            own_bytes = 0
+            shared_bytes = 0
+            for string_id, string in strings[name].items():
+                if owners[string_id] == 1:
+                    own_bytes += sys.getsizeof(string)
+                else:
+                    shared_bytes += sys.getsizeof(string) / owners[string_id]
+            structure_bytes = file_index.structure_size()
+            report.append({
+                'file': name,
+                'options': len(file_index.leaves),
+                'structure_bytes': structure_bytes,
+                'string_bytes': own_bytes,
+                'shared_string_bytes': round(shared_bytes),
+                'total_bytes': structure_bytes + own_bytes + round(shared_bytes),
+            })
+        return report
+
+    def __getitem__(self, name):
+        return self._files[name].to_data()
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+
+def find_tag_options(tags, location):
+    path = (location,) if isinstance(location, str) else tuple(location)
+    options = tags.lookup(path)
+
+    if options is None:
+        if isinstance(location, str):
+            return [f"Error: tag '{location}' not found"]
+        missing = next(path[i - 1] for i in range(1, len(path) + 1) if tags.lookup(path[:i]) is None)
+        return [f"Error: tag '{':'.join(location)}' not found at '{missing}'"]
+
+    if not options:
+        return [f"Error: no options found for tag '{location if isinstance(location, str) else ':'.join(location)}'"]
+    return options
@@ -0,0 +1,72 @@
+"""プロンプト中の @...@ テンプレートの解析"""
+from functools import lru_cache
+from typing import NamedTuple
+import re
+
+# "@2-3!$$ref@" のように個数の後に ! を付けると、重複なし・順不同で選ぶ
+TEMPLATE_PATTERN = re.compile(r'(@((?P<num>\d+(-\d+)?)(?P<distinct>!)?\$\$)?(?P<ref>[^>]+?)@)')
+# タグの値の先頭の "3::" はランダム選択の重み (Dynamic Prompts と同じ書き方)
+WEIGHT_PATTERN = re.compile(r'\s*(?P<weight>\d+(\.\d*)?|\.\d+)::')
+COMPILED_PROMPT_CACHE_SIZE = 512
+
+
+class Template(NamedTuple):
+    template: str
+    ref: tuple
+    min_count: int
+    max_count: int
+    distinct: bool = False
+
+
+def parse_template(template_match):
+    template = template_match.group()
+    num_str = template_match.group('num')
+    ref = template_match.group('ref')
+
+    min_count, max_count = 1, 1
+    if num_str:
+        try:
+            result = list(map(lambda x: int(x), num_str.split('-')))
+            min_count = min(result)
+            max_count = max(result)
+        except Exception:
+            pass
+
+    return Template(template, tuple(ref.split(':')), min_count, max_count, template_match.group('distinct') is not None)
+
+
+def parse_weighted_option(option):
+    """タグの値を (重み, 重みを除いた値) に分ける。重みの指定がなければ重みは 1"""
+    match = WEIGHT_PATTERN.match(option)
+    if match is None:
+        return 1, option
+    return float(match.group('weight')), option[match.end():]
+
+
+class CompiledPrompt(NamedTuple):
+    """テンプレートの前後のリテラル部分 (len(templates) + 1 個) とテンプレートの並び"""
+    literals: tuple
+    templates: tuple
+
+    def substitute(self, replacements):
+        parts = [self.literals[0]]
+        for replacement, literal in zip(replacements, self.literals[1:]):
+            parts.append(replacement)
+            parts.append(literal)
+        return ''.join(parts)
+
+
+def parse_prompt(prompt):
+    literals = []
+    templates = []
+    position = 0
+    for match in TEMPLATE_PATTERN.finditer(prompt):
+        literals.append(prompt[position:match.start()])
+        templates.append(parse_template(match))
+        position = match.end()
+    literals.append(prompt[position:])
+    return CompiledPrompt(tuple(literals), tuple(templates))
+
+
+# UI やバッチで同じプロンプトが繰り返し来るので、解析結果をキャッシュする
+compile_prompt = lru_cache(maxsize=COMPILED_PROMPT_CACHE_SIZE)(parse_prompt)
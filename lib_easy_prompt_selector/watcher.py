@@ -0,0 +1,159 @@
+"""タグディレクトリの監視と、バックグラウンドでの自動読み直し
+
+watchdog がインストールされていればそのイベント (Linux では inotify) で、無ければ定期的な stat で変更を検出する。
+連続した変更 (同期ツールによる複数ファイルの書き込みなど) は、ファイルの状態が落ち着くまで待ってから 1 回で読み直す。
+"""
+import threading
+import time
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+POLL_INTERVAL = 0.5
+# 最後の変更からこの時間変化がなければ読み直す
+DEBOUNCE_SECONDS = 0.2
+# 変更が続いていても、最初の変更からこの時間が経ったら読み直す
+MAX_DELAY_SECONDS = 2.0
+# 読み直しに失敗したら、この間隔 (失敗が続くたびに 2 倍、最大 MAX_RETRY_SECONDS) で再試行する
+RETRY_SECONDS = 1.0
+MAX_RETRY_SECONDS = 30.0
+
+
+class _ChangeHandler(FileSystemEventHandler):
+    def __init__(self, changed):
+        super().__init__()
+        self.changed = changed
+
+    def on_any_event(self, event):
+        self.changed.set()
+
+
+class TagWatcher:
+    """tags_dir の *.yml を監視し、変更があれば reload をバックグラウンドのスレッドで呼ぶ
+
+    reload (store.load_tags) は変更されたファイルだけを読み直し、完成したライブラリを差し替えるので、
+    生成中のジョブや UI のリクエストは読み込みを待たない。
+    """
+
+    def __init__(self, tags_dir, reload, poll_interval=POLL_INTERVAL, debounce=DEBOUNCE_SECONDS, max_delay=MAX_DELAY_SECONDS, retry_delay=RETRY_SECONDS):
+        self.tags_dir = tags_dir
+        self.reload = reload
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self._changed = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._observer = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def backend(self):
+        return 'watchdog' if self._observer is not None else 'polling'
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self._stopping.clear()
+            self._changed.clear()
+            self._observer = self.start_observer()
+            self._thread = threading.Thread(target=self.run, name='eps-tag-watcher', daemon=True)
+            self._thread.start()
+            print(f"[EasyPromptSelector] Watching {self.tags_dir} for tag changes ({self.backend})")
+
+    def stop(self):
+        with self._lock:
+            self._stopping.set()
+            self._changed.set()
+            if self._observer is not None:
+                self._observer.stop()
+                self._observer.join(timeout=5)
+                self._observer = None
+            if self._thread is not None:
+                self._thread.join(timeout=5)
+                self._thread = None
+
+    def start_observer(self):
+        if Observer is None:
+            return None
+        try:
+            observer = Observer()
+            observer.schedule(_ChangeHandler(self._changed), str(self.tags_dir), recursive=True)
+            observer.daemon = True
+            observer.start()
+            return observer
+        except Exception as e:
+            # inotify の監視数の上限などで使えない場合はポーリングにする
+            print(f"[EasyPromptSelector] File system events unavailable, polling instead: {e}")
+            return None
+
+    def snapshot(self):
+        """*.yml の (パス, mtime, サイズ) の集合。読めない場合は None"""
+        try:
+            return frozenset(
+                (str(filepath), stat.st_mtime_ns, stat.st_size)
+                for filepath in self.tags_dir.rglob('*.yml')
+                for stat in (filepath.stat(),)
+            )
+        except OSError:
+            return None
+
+    def wait_for_change(self, last):
+        """変更を検出するまで待つ。停止した場合は False"""
+        while not self._stopping.is_set():
+            if self._observer is not None:
+                self._changed.wait()
+                self._changed.clear()
+                return not self._stopping.is_set()
+            if self._stopping.wait(self.poll_interval):
+                return False
+            if self.snapshot() != last:
+                return True
+        return False
+
+    def settle(self):
+        """ファイルの状態が debounce 秒変わらなくなるまで (最大 max_delay 秒) 待ち、その状態を返す"""
+        deadline = time.monotonic() + self.max_delay
+        current = self.snapshot()
+        while time.monotonic() < deadline:
+            if self._stopping.wait(self.debounce):
+                break
+            self._changed.clear()
+            latest = self.snapshot()
+            if latest == current:
+                break
+            current = latest
+        return current
+
+    def run(self):
+        last = self.snapshot()
+        failures = 0
+        while self.wait_for_change(last):
+            current = self.settle()
+            if self._stopping.is_set():
+                break
+            if current == last and failures == 0:
+                continue # *.yml 以外の変更や、元に戻された変更
+            try:
+                self.reload()
+            except Exception as e:
+                # last は進めずに、間隔を空けて読み直しを再試行する (同期中のファイルが一時的に読めない場合など)
+                failures += 1
+                delay = min(self.retry_delay * 2 ** (failures - 1), MAX_RETRY_SECONDS)
+                print(f"[EasyPromptSelector] Failed to reload tags (retrying in {delay:.1f}s): {e}")
+                if self._stopping.wait(delay):
+                    break
+                self._changed.set()
+                continue
+            failures = 0
+            last = current
@@ -0,0 +1,166 @@
+from typing import List, Literal, Optional, Union
+import gzip
+import threading
+
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+from starlette.middleware.gzip import GZipMiddleware
+
+from modules import script_callbacks
+
+from lib_easy_prompt_selector.bundle import TagBundle
+from lib_easy_prompt_selector.engine import template_combinations_count
+from lib_easy_prompt_selector.metrics import metrics
+from lib_easy_prompt_selector.preview import DEFAULT_SALT, preview_batch
+from lib_easy_prompt_selector.search import SearchIndex
+from lib_easy_prompt_selector.store import current_tags
+from lib_easy_prompt_selector.templates import compile_prompt
+
+ROUTE_PREFIX = '/easy-prompt-selector'
+SEARCH_PAGE_SIZE_MAX = 200
+PREVIEW_PAGE_SIZE_MAX = 1000
+PREVIEW_BATCH_SIZE_MAX = 1000
+# 1 回の呼び出しで展開するプロンプトの合計 (limit の合計) の上限。リクエストのスレッドで全件をメモリ上に作るため
+PREVIEW_TOTAL_MAX = 20000
+
+current_bundle = None
+_bundle_lock = threading.Lock()
+current_search_index = None
+_search_lock = threading.Lock()
+
+
+class ExpandRequest(BaseModel):
+    """1 つのプロンプトのプレビュー。random モードの index i はシード seed + i (WebUI のバッチと同じ)"""
+    prompt: str
+    mode: Literal['round_robin', 'shuffle', 'random'] = 'round_robin'
+    start: int = Field(0, ge=0)
+    limit: int = Field(20, ge=1, le=PREVIEW_PAGE_SIZE_MAX)
+    seed: Optional[int] = None
+    salt: str = DEFAULT_SALT
+    unique: bool = False
+
+
+class ExpandBatchRequest(BaseModel):
+    requests: List[ExpandRequest]
+
+
+def get_bundle():
+    """公開中のタグのバンドル。ライブラリが差し替わっていれば作り直す (前のバンドルとの差分を返せるように引き継ぐ)
+
+    タグの読み直しは 🔄 ボタンと監視スレッドに任せ、ここでは読み込まない (GET でライブラリや進捗のキーが変わらないように)。
+    """
+    global current_bundle
+    library = current_tags()
+    bundle = current_bundle
+    if bundle is None or bundle.library_version != library.version:
+        with _bundle_lock:
+            bundle = current_bundle
+            if bundle is None or bundle.library_version != library.version:
+                bundle = current_bundle = TagBundle(library, bundle)
+    return bundle
+
+
+def get_search_index():
+    """現在のタグの検索索引。タグが変わっていれば、変更されたファイルの分だけ作り直す"""
+    global current_search_index
+    library = current_tags()
+    index = current_search_index
+    if index is None or index.library_version != library.version:
+        with _search_lock:
+            index = current_search_index
+            if index is None or index.library_version != library.version:
+                index = current_search_index = SearchIndex(library, index)
+    return index
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('if-none-match', '')
+    return any(candidate.strip().removeprefix('W/') == etag for candidate in if_none_match.split(','))
+
+
+def on_app_started(demo, app: FastAPI):
+    # WebUI が GZipMiddleware を入れている場合は圧縮をそちらに任せる (二重圧縮しない)
+    compress = not any(middleware.cls is GZipMiddleware for middleware in app.user_middleware)
+
+    def tags_bundle(request: Request, since: str = None):
+        """パース済みの全タグを 1 つの JSON で返す。since を指定するとそのバージョンからの差分を返す"""
+        bundle = get_bundle()
+        headers = {'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+
+        body = bundle.delta(since) if since and since != bundle.version else None
+        headers['ETag'] = f'"{bundle.version}"' if body is None else f'"{bundle.version}-{since}"'
+        if since == bundle.version or etag_matches(request, headers['ETag']):
+            return Response(status_code=304, headers=headers)
+
+        gzip_body = None
+        if body is None:
+            body, gzip_body = bundle.body, bundle.gzip_body
+        if compress and 'gzip' in request.headers.get('accept-encoding', ''):
+            body = gzip_body or gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        return Response(content=body, media_type='application/json', headers=headers)
+
+    def tag_file_index(request: Request):
+        """タグファイルの一覧と各ファイルのハッシュ (ブラウザは最初にこれだけを取得する)"""
+        bundle = get_bundle()
+        headers = {'Cache-Control': 'no-cache', 'ETag': f'"{bundle.version}"'}
+        if etag_matches(request, headers['ETag']):
+            return Response(status_code=304, headers=headers)
+        return Response(content=bundle.index_body, media_type='application/json', headers=headers)
+
+    def tag_file(name: str, request: Request, v: str = None):
+        """1 ファイル分のタグ。v に一覧のハッシュを付けたリクエストは内容が変わらないので、ブラウザにキャッシュさせる"""
+        bundle = get_bundle()
+        if name not in bundle.files:
+            raise HTTPException(status_code=404, detail=f"Tag file '{name}' not found")
+        digest = bundle.digests[name]
+        cache_control = 'public, max-age=31536000, immutable' if v == digest else 'no-cache'
+        headers = {'Cache-Control': cache_control, 'ETag': f'"{digest}"', 'Vary': 'Accept-Encoding'}
+        if etag_matches(request, headers['ETag']):
+            return Response(status_code=304, headers=headers)
+
+        compressed = compress and 'gzip' in request.headers.get('accept-encoding', '')
+        if compressed:
+            headers['Content-Encoding'] = 'gzip'
+        return Response(content=bundle.file_body(name, compressed), media_type='application/json', headers=headers)
+
+    def search_tags(q: str = '', offset: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=SEARCH_PAGE_SIZE_MAX), file: List[str] = Query(None)):
+        """全タグファイルのキー・値・パスを検索し、点数の高い順に offset から limit 件を返す"""
+        return get_search_index().search(q, offset, limit, file)
+
+    def expand(request: Union[ExpandBatchRequest, ExpandRequest]):
+        """プロンプトの組み合わせ数と展開結果の 1 ページを返す。{"requests": [...]} ならまとめて処理する
+
+        バッチ内のリクエストはすべて同じタグのスナップショットで展開する。
+        """
+        tags = current_tags()
+        if isinstance(request, ExpandBatchRequest):
+            if len(request.requests) > PREVIEW_BATCH_SIZE_MAX:
+                raise HTTPException(status_code=422, detail=f"At most {PREVIEW_BATCH_SIZE_MAX} requests per batch")
+            if sum(item.limit for item in request.requests) > PREVIEW_TOTAL_MAX:
+                raise HTTPException(status_code=422, detail=f"At most {PREVIEW_TOTAL_MAX} prompts (the sum of limit) per batch")
+            results = preview_batch(tags, [item.dict() for item in request.requests])
+            return {'library': tags.digest, 'results': results}
+        return {'library': tags.digest, **preview_batch(tags, [request.dict()])[0]}
+
+    def metrics_text():
+        """計測結果を Prometheus のテキスト形式で返す (設定で計測を有効にした場合のみ値が増える)"""
+        text = metrics.render([('compile_prompt', compile_prompt), ('template_combinations_count', template_combinations_count)])
+        return PlainTextResponse(text, media_type='text/plain; version=0.0.4')
+
+    def memory_report():
+        """タグファイルごとのメモリ使用量の見積もり (大きい順)"""
+        files = sorted(current_tags().memory_report(), key=lambda entry: entry['total_bytes'], reverse=True)
+        return {'total_bytes': sum(entry['total_bytes'] for entry in files), 'files': files}
+
+    app.add_api_route(f'{ROUTE_PREFIX}/tags', tags_bundle, methods=['GET'])
+    app.add_api_route(f'{ROUTE_PREFIX}/files', tag_file_index, methods=['GET'])
+    app.add_api_route(f'{ROUTE_PREFIX}/files/{{name}}', tag_file, methods=['GET'])
+    app.add_api_route(f'{ROUTE_PREFIX}/search', search_tags, methods=['GET'])
+    app.add_api_route(f'{ROUTE_PREFIX}/expand', expand, methods=['POST'])
+    app.add_api_route(f'{ROUTE_PREFIX}/memory', memory_report, methods=['GET'])
+    app.add_api_route(f'{ROUTE_PREFIX}/metrics', metrics_text, methods=['GET'])
+
+
+script_callbacks.on_app_started(on_app_started)
@@ -1,8 +1,35 @@
 from modules import script_callbacks, shared
 
+from lib_easy_prompt_selector.metrics import metrics
+from lib_easy_prompt_selector.store import tag_watcher
+
+
+def update_metrics():
+    metrics.enabled = shared.opts.eps_enable_metrics
+
+
+def update_tag_watcher():
+    if shared.opts.eps_watch_tags:
+        tag_watcher.start()
+    else:
+        tag_watcher.stop()
+
+
 def on_ui_settings():
     shared.opts.add_option("eps_enable_save_raw_prompt_to_pnginfo", shared.OptionInfo(False, "元プロンプトを pngninfo に保存する", section=("easy_prompt_selector", "EasyPromptSelector")))
     shared.opts.add_option("eps_show_current_combination", shared.OptionInfo(True, "現在の組合せ数を表示する", section=("easy_prompt_selector", "EasyPromptSelector")))
     shared.opts.add_option("eps_prompt_textbox_input", shared.OptionInfo(True, "現在の組合せ数を UI に表示する", section=("easy_prompt_selector", "EasyPromptSelector")))
+    shared.opts.add_option("eps_enable_metrics", shared.OptionInfo(False, "プロンプト展開の処理時間を計測する (/easy-prompt-selector/metrics で確認できる)", onchange=update_metrics, section=("easy_prompt_selector", "EasyPromptSelector")))
+    shared.opts.add_option("eps_save_timing_to_pnginfo", shared.OptionInfo(False, "計測した処理時間を EPS Timing として pnginfo に保存する (計測が有効な場合)", section=("easy_prompt_selector", "EasyPromptSelector")))
+    shared.opts.add_option("eps_watch_tags", shared.OptionInfo(False, "タグファイルの変更を監視して自動で読み直す", onchange=update_tag_watcher, section=("easy_prompt_selector", "EasyPromptSelector")))
+
+
+def on_app_started(demo, app):
+    update_metrics()
+    update_tag_watcher()
+
 
 script_callbacks.on_ui_settings(on_ui_settings)
+script_callbacks.on_app_started(on_app_started)
+# UI のリロードでスクリプトが読み込み直される前に、古い監視スレッドを止める
+script_callbacks.on_script_unloaded(tag_watcher.stop)
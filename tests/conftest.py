@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# リポジトリのルートから lib_easy_prompt_selector を読み込む (WebUI の modules は使わない)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
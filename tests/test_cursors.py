@@ -0,0 +1,58 @@
+import multiprocessing
+
+from lib_easy_prompt_selector.cursors import CursorStore
+
+KEY = 'prompt'
+
+
+def span(lease):
+    return lease.start, lease.stop
+
+
+def reserve_many(path, rounds):
+    """別のプロセスで同じデータベースから予約を繰り返し、得たインデックスを返す"""
+    store = CursorStore(path)
+    indexes = []
+    for round_index in range(rounds):
+        reserved, leases = store.reserve_indexes(KEY, round_index % 4 + 1)
+        indexes.extend(reserved)
+        store.complete(leases)
+    return indexes
+
+
+def test_two_processes_never_reserve_the_same_index(tmp_path):
+    path = tmp_path / 'cursors.sqlite3'
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(2) as pool:
+        results = pool.starmap(reserve_many, [(path, 200), (path, 200)])
+    indexes = [index for result in results for index in result]
+    assert len(indexes) == len(set(indexes))
+    assert sorted(indexes) == list(range(len(indexes)))
+    assert CursorStore(path).position(KEY) == len(indexes)
+
+
+def test_expired_lease_is_handed_to_the_next_reservation(tmp_path):
+    path = tmp_path / 'cursors.sqlite3'
+    crashed = CursorStore(path, lease_seconds=-1) # 予約したまま落ちたワーカー
+    assert span(crashed.reserve(KEY, 5)) == (0, 5)
+
+    store = CursorStore(path)
+    # 必要な分だけ引き継ぎ、残りは期限切れのまま次の予約に回る
+    assert span(store.reserve(KEY, 3)) == (0, 3)
+    indexes, leases = store.reserve_indexes(KEY, 5)
+    assert indexes == [3, 4, 5, 6, 7]
+    assert [span(lease) for lease in leases] == [(3, 5), (5, 8)]
+    assert store.position(KEY) == 8
+
+
+def test_live_and_completed_leases_are_not_reclaimed(tmp_path):
+    path = tmp_path / 'cursors.sqlite3'
+    worker = CursorStore(path)
+    live = worker.reserve(KEY, 2)
+    finished = CursorStore(path, lease_seconds=-1)
+    done = finished.reserve(KEY, 2)
+    finished.complete([done])
+
+    assert span(CursorStore(path).reserve(KEY, 2)) == (4, 6)
+    worker.complete([live])
+    assert span(CursorStore(path).reserve(KEY, 1)) == (6, 7)
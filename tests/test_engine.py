@@ -0,0 +1,107 @@
+from collections import Counter
+from itertools import combinations, product
+from math import prod
+
+import pytest
+
+from lib_easy_prompt_selector.engine import (
+    combination_at,
+    count_combinations,
+    decode_distinct_selection,
+    distinct_subset_count,
+    resolve_node,
+    resolve_templates,
+)
+from lib_easy_prompt_selector.tags import TagLibrary
+from lib_easy_prompt_selector.templates import compile_prompt, parse_prompt
+
+TAGS = {
+    'h': {
+        'Style': ['bob', 'ponytail', 'twintails'],
+        'Color': ['red', 'blue'],
+        'Mix': [
+            '@h:Style@ hair',
+            'plain',
+            '@1-2$$h:Color@ dress',
+            '2::@2!$$h:Style@ set',
+            'solo',
+        ],
+    },
+}
+
+
+@pytest.fixture(scope='module')
+def tags():
+    return TagLibrary(TAGS)
+
+
+def expand_option(tags, option):
+    """選択肢の展開を素朴に列挙する"""
+    compiled = parse_prompt(option)
+    if not compiled.templates:
+        return [option]
+    return [compiled.substitute(choice) for choice in product(*(enumerate_template(tags, template) for template in compiled.templates))]
+
+
+def enumerate_selections(tags, options, size, distinct):
+    expanded = [expand_option(tags, option) for option in options]
+    picks = combinations(range(len(options)), size) if distinct else product(range(len(options)), repeat=size)
+    return [', '.join(parts) for pick in picks for parts in product(*(expanded[i] for i in pick))]
+
+
+def enumerate_template(tags, template):
+    options = resolve_node(tags, template.ref).options
+    return [
+        selection
+        for size in range(template.min_count, template.max_count + 1)
+        for selection in enumerate_selections(tags, options, size, template.distinct)
+    ]
+
+
+@pytest.mark.parametrize('ref', [('h', 'Style'), ('h', 'Mix')])
+@pytest.mark.parametrize('size', range(6))
+def test_decode_distinct_selection_matches_enumeration(tags, ref, size):
+    node = resolve_node(tags, ref)
+    expected = enumerate_selections(tags, node.options, size, distinct=True) if size <= len(node.options) else []
+    count = distinct_subset_count(node, 0, size)
+    assert count == len(expected)
+    decoded = [decode_distinct_selection(node, size, index) for index in range(count)]
+    assert Counter(decoded) == Counter(expected)
+    assert len(set(decoded)) == count # 別の番号が同じ選び方にならない
+
+
+def test_distinct_subset_count_with_nested_weights(tags):
+    node = resolve_node(tags, ('h', 'Mix'))
+    # 選択肢ごとの展開数は 3, 1, 6, 3, 1 (重み付きの選択肢も展開数は変わらない)
+    weights = [3, 1, 6, 3, 1]
+    for start in range(len(weights) + 1):
+        for size in range(len(weights) + 2):
+            expected = sum(
+                prod(weights[i] for i in chosen)
+                for chosen in combinations(range(start, len(weights)), size)
+            )
+            assert distinct_subset_count(node, start, size) == expected
+
+
+@pytest.mark.parametrize('prompt', [
+    '@0-3!$$h:Mix@',
+    '@2!$$h:Style@ and @h:Mix@',
+    '@1-2$$h:Color@, @2-3!$$h:Mix@',
+])
+def test_combination_at_matches_enumeration(tags, prompt):
+    compiled = compile_prompt(prompt)
+    expected = [compiled.substitute(choice) for choice in product(*(enumerate_template(tags, template) for template in compiled.templates))]
+    result = count_combinations(tags, prompt)
+    assert result.error is None
+    assert result.total == len(expected)
+    resolved = resolve_templates(tags, compiled.templates)
+    decoded = [compiled.substitute(combination_at(resolved, index)) for index in range(result.total)]
+    assert Counter(decoded) == Counter(expected)
+
+
+def test_circular_reference_error_is_prefixed_once():
+    tags = TagLibrary({'loop': {'a': ['@loop:b@'], 'b': ['@loop:a@'], 'c': ['x @loop:a@']}})
+    assert resolve_templates(tags, parse_prompt('@loop:a@').templates) == "Error: circular reference in tag 'loop:a'"
+    slot, = resolve_templates(tags, parse_prompt('@loop:c@').templates)
+    _, (nested,) = slot.node.expansions[0]
+    assert nested.error == "Error: circular reference in tag 'loop:a'"
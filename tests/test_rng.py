@@ -0,0 +1,93 @@
+from collections import Counter
+
+import pytest
+
+from lib_easy_prompt_selector.rng import AliasTable, FeistelPermutation, StableRandom
+
+WEIGHTS = [
+    [1, 1, 1],
+    [3, 1],
+    [0.5, 2, 0, 1.5, 6],
+    [1, 1000],
+    [7],
+]
+
+
+def implied_probabilities(table):
+    """別名表から各列が選ばれる確率を計算する"""
+    count = len(table)
+    probabilities = [0.0] * count
+    for column in range(count):
+        probabilities[column] += table.probabilities[column] / count
+        probabilities[table.aliases[column]] += (1.0 - table.probabilities[column]) / count
+    return probabilities
+
+
+@pytest.mark.parametrize('weights', WEIGHTS)
+def test_alias_table_matches_weights(weights):
+    total = sum(weights)
+    assert implied_probabilities(AliasTable(weights)) == pytest.approx([weight / total for weight in weights])
+
+
+@pytest.mark.parametrize('weights', WEIGHTS)
+def test_alias_table_draw_frequencies(weights):
+    draws = 40000
+    counts = Counter(AliasTable(weights).sample(StableRandom('alias', weights), draws))
+    total = sum(weights)
+    for column, weight in enumerate(weights):
+        expected = weight / total
+        assert counts[column] / draws == pytest.approx(expected, abs=4 * (expected * (1 - expected) / draws) ** 0.5 + 1e-9)
+
+
+def test_sample_distinct_first_pick_follows_weights():
+    weights = [1, 2, 3, 4]
+    table = AliasTable(weights)
+    rng = StableRandom('distinct')
+    draws = 20000
+    counts = Counter(table.sample_distinct(rng, 1)[0] for _ in range(draws))
+    for column, weight in enumerate(weights):
+        assert counts[column] / draws == pytest.approx(weight / 10, abs=0.015)
+
+
+def test_sample_distinct_uses_zero_weights_last():
+    table = AliasTable([0, 1, 0, 2])
+    rng = StableRandom('zero')
+    for _ in range(200):
+        picks = table.sample_distinct(rng, 2)
+        assert sorted(picks) == [1, 3]
+        picks = table.sample_distinct(rng, 4)
+        assert sorted(picks) == [0, 1, 2, 3]
+        assert set(picks[:2]) == {1, 3}
+
+
+def test_feistel_permutation_is_a_bijection_for_sizes_up_to_5000():
+    # 鍵と半分のビット数が同じなら _encrypt は同じなので、一度だけ表にして cycle walking (__call__) を全サイズで確かめる
+    tables = {}
+    for size in range(1, 5001):
+        permutation = FeistelPermutation(size, 'bijection')
+        table = tables.get(permutation.half_bits)
+        if table is None:
+            table = tables[permutation.half_bits] = [permutation._encrypt(value) for value in range(1 << (2 * permutation.half_bits))]
+            assert sorted(table) == list(range(len(table)))
+        permutation._encrypt = table.__getitem__
+        assert sorted(map(permutation, range(size))) == list(range(size))
+
+
+@pytest.mark.parametrize('size', [2, 3, 17, 1000, 4097])
+def test_feistel_permutation_without_table(size):
+    permutation = FeistelPermutation(size, 'direct')
+    values = [permutation(index) for index in range(size)]
+    assert sorted(values) == list(range(size))
+    assert values == [FeistelPermutation(size, 'direct')(index) for index in range(size)]
+    if size > 3:
+        assert values != [FeistelPermutation(size, 'other')(index) for index in range(size)]
+
+
+def test_feistel_permutation_rejects_out_of_range_indexes():
+    permutation = FeistelPermutation(10, 'range')
+    with pytest.raises(IndexError):
+        permutation(10)
+    with pytest.raises(IndexError):
+        permutation(-1)
+    with pytest.raises(ValueError):
+        FeistelPermutation(0)
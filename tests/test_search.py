@@ -0,0 +1,30 @@
+from lib_easy_prompt_selector.search import SearchIndex
+from lib_easy_prompt_selector.tags import TagLibrary
+
+TAGS = {
+    'colors': {
+        'Green': ['3::green', 'greenery'],
+        'Quality': {'best': '2::1girl, (masterpiece:1.2)'},
+    },
+}
+
+
+def search(query):
+    return SearchIndex(TagLibrary(TAGS)).search(query)
+
+
+def test_weighted_value_matches_exactly_without_its_weight():
+    page = search('green')
+    top = page['results'][0]
+    assert (top['key'], top['value'], top['score']) == ('green', 'green', 1.0)
+    assert [result['key'] for result in page['results'] if result['kind'] == 'tag'] == ['green', 'greenery']
+
+    best = search('best')['results'][0]
+    assert (best['key'], best['value']) == ('best', '1girl, (masterpiece:1.2)')
+    assert search('3')['total'] == 0 # 重みだけには一致しない
+
+
+def test_short_query_with_punctuation_matches_substring():
+    for query in ('(m', '(ma', ', (m'):
+        values = [result['value'] for result in search(query)['results']]
+        assert values == ['1girl, (masterpiece:1.2)'], query